@@ -0,0 +1,128 @@
+"""
+Import time benchmark of the base module.
+
+Every module is imported in a fresh interpreter, a number of times, and the
+best time is kept along with the number of modules it loaded.
+With an interpreter supporting `-X importtime` (Python 3.7+), the cumulative
+time it reports is used instead. Otherwise it is measured around the import.
+
+Save a baseline, then compare to it to catch regressions:
+    python benchmarks/importtime.py --save baseline.json
+    python benchmarks/importtime.py --baseline baseline.json
+"""
+import re
+import sys
+import json
+import argparse
+import subprocess
+
+MODULES = (
+    'cbmod.base',
+    'cbmod.base.models',
+    'cbmod.base.views',
+    'cbmod.base.views.window',
+    'cbmod.base.views.widgets',
+    'cbmod.base.controllers.printing',
+)
+
+MEASURE = """
+import sys, time
+before = set(sys.modules)
+start = time.time()
+import {module}
+elapsed = time.time() - start
+import json
+sys.stdout.write(json.dumps({{'time': elapsed,
+                             'modules': sorted(m for m in set(sys.modules) - before
+                                                if sys.modules[m] is not None)}}))
+"""
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S+)\s*$')
+
+def supports_importtime(python):
+    code = 'import sys; sys.exit(0 if sys.version_info >= (3, 7) else 1)'
+    return subprocess.call([python, '-c', code]) == 0
+
+def measure(python, module, importtime=False):
+    """
+    Imports `module` in a new interpreter, returns (seconds, loaded module names).
+    """
+    process = subprocess.Popen([python] + (['-X', 'importtime'] if importtime else []) +
+                               ['-c', MEASURE.format(module=module)],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('Could not import {}:\n{}'.format(module, err.decode('utf-8', 'replace')))
+
+    result = json.loads(out.decode('utf-8'))
+    if importtime:
+        # The cumulative time of the module itself, in microseconds
+        for line in err.decode('utf-8', 'replace').splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if match and match.group(4) == module:
+                result['time'] = int(match.group(2)) / 1e6
+    return result['time'], result['modules']
+
+def run(python, modules, repeat):
+    importtime = supports_importtime(python)
+    results = {}
+    for module in modules:
+        times = []
+        loaded = []
+        for _ in range(repeat):
+            elapsed, loaded = measure(python, module, importtime)
+            times.append(elapsed)
+        results[module] = {'time': min(times), 'modules': len(loaded)}
+        sys.stdout.write('{:<40} {:>8.1f}ms {:>5} modules\n'.format(module, min(times)*1000, len(loaded)))
+    return results
+
+def compare(baseline, results, tolerance):
+    """
+    Returns the modules whose import time got slower than the baseline
+    by more than `tolerance` (a ratio), or which load more modules.
+    """
+    regressions = []
+    for module, result in sorted(results.items()):
+        try:
+            reference = baseline[module]
+        except KeyError:
+            continue
+        if result['time'] > reference['time'] * (1 + tolerance) or \
+                result['modules'] > reference['modules']:
+            regressions.append((module, reference, result))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the import time of the base module.')
+    parser.add_argument('modules', nargs='*', metavar='MODULE',
+                        help='modules to import (default: the main ones of cbmod.base)')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to run the imports with')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of imports of each module, the best is kept')
+    parser.add_argument('--save', metavar='FILE', help='write the results to this JSON file')
+    parser.add_argument('--baseline', metavar='FILE', help='compare the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown ratio allowed compared to the baseline')
+    args = parser.parse_args(argv)
+
+    results = run(args.python, args.modules or MODULES, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.tolerance)
+        for module, reference, result in regressions:
+            sys.stdout.write('REGRESSION {}: {:.1f}ms ({} modules), was {:.1f}ms ({} modules)\n'.format(
+                                module, result['time']*1000, result['modules'],
+                                reference['time']*1000, reference['modules']))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+"""
+Printing benchmarks: rendering time of the print jobs, from receipts to long
+reports, and the cost of loading printers and handling jobs.
+
+Jobs are printed to PDF files in a temporary directory, so no printer is
+needed. The Qt platform is set to offscreen where supported (Qt 5); with
+Qt 4 on X11 and no display, the benchmarks are run again under xvfb-run.
+Every case runs in a process of its own, for its peak memory to be its own.
+
+    python benchmarks/printing.py --save baseline.json
+    python benchmarks/printing.py --baseline baseline.json
+    python benchmarks/printing.py table-2000 streaming-20000
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+
+RECEIPT_LINES = 20
+
+PDF_PAGE = re.compile(r'/Type\s*/Page\b')
+
+def receipt_rows(count):
+    return [(u'Item {}'.format(i), i % 7 + 1, u'{:.2f}'.format(i * 1.25)) for i in xrange(count)]
+
+def make_doc_job(size):
+    from cbmod.base.controllers import printing
+    job = printing.DocPrintJob()
+    job.header = u'Coinbox\nBenchmark receipt'
+    job.content = u'\n'.join(u'Line {} of the receipt'.format(i) for i in xrange(size))
+    job.footer = u'Thank you!'
+    return job
+
+def make_table_job(size):
+    from cbmod.base.controllers import printing
+    job = printing.TablePrintJob(receipt_rows(size), (u'Item', u'Qty', u'Total'), (u'Total', u'', u'0.00'))
+    job.header = u'Coinbox\nBenchmark report'
+    job.footer = u'Thank you!'
+    return job
+
+def make_streaming_job(size):
+    from cbmod.base.controllers import printing
+    job = printing.StreamingTablePrintJob(lambda: (row for row in receipt_rows(size)),
+                                          (u'Item', u'Qty', u'Total'), (u'Total', u'', u'0.00'),
+                                          columns=(3, 1, 1))
+    job.header = u'Coinbox\nBenchmark report'
+    job.footer = u'Thank you!'
+    return job
+
+def make_html_job(size):
+    from cbmod.base.controllers import printing
+    job = printing.HTMLPrintJob()
+    job.header = u'<h1>Coinbox</h1><p>Benchmark report</p>'
+    job.content = u'<table width="100%"><tr><th>Item</th><th>Qty</th><th>Total</th></tr>{}</table>'.format(
+                    u''.join(u'<tr><td>{}</td><td>{}</td><td>{}</td></tr>'.format(*row)
+                                for row in receipt_rows(size)))
+    job.footer = u'<p align="center">Thank you!</p>'
+    return job
+
+JOBS = {
+    'doc': make_doc_job,
+    'table': make_table_job,
+    'streaming': make_streaming_job,
+    'html': make_html_job,
+}
+
+SIZES = {
+    'doc': (RECEIPT_LINES, 200, 2000),
+    'table': (RECEIPT_LINES, 200, 2000),
+    'streaming': (RECEIPT_LINES, 200, 2000, 20000),
+    'html': (RECEIPT_LINES, 200, 2000),
+}
+
+def all_cases():
+    cases = ['{}-{}'.format(kind, size) for kind in sorted(JOBS) for size in SIZES[kind]]
+    return cases + ['deserialize-1000', 'handle-100']
+
+def peak_rss():
+    """
+    Returns the peak resident memory of the process, in KB.
+    """
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # In bytes
+        rss //= 1024
+    return rss
+
+def application():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide import QtGui
+    return QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+
+def pdf_printer(directory, name):
+    from PySide import QtGui
+    from cbmod.base.controllers import printing
+
+    qprinter = QtGui.QPrinter(QtGui.QPrinter.HighResolution)
+    qprinter.setOutputFormat(QtGui.QPrinter.PdfFormat)
+    qprinter.setOutputFileName(os.path.join(directory, name+'.pdf'))
+    return printing.Printer(name, qprinter)
+
+def page_count(path):
+    """
+    Returns the number of pages of the PDF file at `path`.
+    """
+    with open(path, 'rb') as f:
+        return len(PDF_PAGE.findall(f.read()))
+
+def run_job(kind, size, directory, repeat):
+    times = []
+    pages = 0
+    for i in xrange(repeat):
+        printer = pdf_printer(directory, '{}-{}-{}'.format(kind, size, i))
+        job = JOBS[kind](size)
+        start = time.time()
+        printer.execute(job)
+        times.append(time.time() - start)
+        pages = page_count(printer.qprinter.outputFileName())
+    best = min(times)
+    return {'time': best, 'pages': pages, 'pages_per_sec': pages / best if best else None}
+
+def run_deserialize(count, directory):
+    from cbmod.base.controllers import printing
+    serial = pdf_printer(directory, 'deserialize').serialized()
+    start = time.time()
+    for i in xrange(count):
+        printing.Printer.from_serialized('deserialize', serial)
+    elapsed = time.time() - start
+    return {'time': elapsed / count, 'total': elapsed}
+
+def run_handle(count, directory, timeout):
+    """
+    Handles `count` receipts through a PrinterManager, with the current
+    printing configuration, and waits until they are all printed.
+    """
+    from PySide import QtGui
+    from cbmod.base.controllers import printing
+
+    printer = pdf_printer(directory, 'handle')
+
+    class BenchmarkManager(printing.PrinterManager):
+        def resolve_printer(self, function):
+            return printer
+
+    manager = BenchmarkManager()
+    start = time.time()
+    for i in xrange(count):
+        manager.handle(make_table_job(RECEIPT_LINES), 'benchmark')
+    returned = time.time() - start
+    while manager.queue_depth() > 0:
+        if time.time() - start > timeout:
+            manager.shutdown(0)
+            raise RuntimeError('{} jobs still queued after {}s'.format(manager.queue_depth(), timeout))
+        # Without threaded font rendering (e.g. Qt 4 on X11),
+        # the queues print from the event loop
+        QtGui.QApplication.processEvents()
+        time.sleep(0.001)
+    elapsed = time.time() - start
+    manager.shutdown()
+    return {'time': elapsed / count, 'handle_time': returned / count, 'total': elapsed}
+
+def run_case(case, repeat, timeout):
+    """
+    Runs one case in this process, returns its results.
+    """
+    kind, _, size = case.rpartition('-')
+    size = int(size)
+
+    app = application()
+    directory = tempfile.mkdtemp(prefix='coinbox-printing-')
+    try:
+        if kind in JOBS:
+            result = run_job(kind, size, directory, repeat)
+        elif kind == 'deserialize':
+            result = run_deserialize(size, directory)
+        elif kind == 'handle':
+            result = run_handle(size, directory, timeout)
+        else:
+            raise ValueError('Unknown case {}'.format(case))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    result['peak_rss'] = peak_rss()
+    return result
+
+def format_result(case, result):
+    line = '{:<20} {:>10.2f}ms {:>8}KB'.format(case, result['time']*1000, result['peak_rss'])
+    if result.get('pages'):
+        line += ' {:>5} pages {:>8.1f} pages/s'.format(result['pages'], result['pages_per_sec'])
+    if 'handle_time' in result:
+        line += ' (caller waited {:.2f}ms)'.format(result['handle_time']*1000)
+    return line
+
+def compare(baseline, results, tolerance):
+    """
+    Returns the cases slower than the baseline by more than `tolerance`.
+    """
+    regressions = []
+    for case, result in sorted(results.items()):
+        reference = baseline.get(case)
+        if reference is not None and result['time'] > reference['time'] * (1 + tolerance):
+            regressions.append((case, reference, result))
+    return regressions
+
+def needs_display():
+    return sys.platform.startswith('linux') and not os.environ.get('DISPLAY') \
+                and not os.environ.get('COINBOX_BENCHMARK_XVFB')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the rendering of print jobs.')
+    parser.add_argument('cases', nargs='*', metavar='CASE',
+                        help='cases to run, e.g. table-2000 (default: all of them)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each job, the best is kept')
+    parser.add_argument('--save', metavar='FILE', help='write the results to this JSON file')
+    parser.add_argument('--baseline', metavar='FILE', help='compare the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown ratio allowed compared to the baseline')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for the queued jobs to be printed')
+    parser.add_argument('--run-case', metavar='CASE', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        sys.stdout.write(json.dumps(run_case(args.run_case, args.repeat, args.timeout)))
+        return 0
+
+    if needs_display() and find_executable('xvfb-run'):
+        env = dict(os.environ, COINBOX_BENCHMARK_XVFB='1')
+        return subprocess.call(['xvfb-run', '-a', sys.executable, os.path.abspath(__file__)] +
+                               (argv if argv is not None else sys.argv[1:]), env=env)
+
+    results = {}
+    for case in args.cases or all_cases():
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                    '--run-case', case, '--repeat', str(args.repeat),
+                                    '--timeout', str(args.timeout)],
+                                   stdout=subprocess.PIPE)
+        out, _ = process.communicate()
+        if process.returncode != 0:
+            sys.stdout.write('{:<20} failed\n'.format(case))
+            continue
+        results[case] = json.loads(out)
+        sys.stdout.write(format_result(case, results[case])+'\n')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.tolerance)
+        for case, reference, result in regressions:
+            sys.stdout.write('REGRESSION {}: {:.2f}ms, was {:.2f}ms\n'.format(
+                                case, result['time']*1000, reference['time']*1000))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
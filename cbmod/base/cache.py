@@ -0,0 +1,206 @@
+import os
+import errno
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PySide import QtGui
+
+import cbpos
+
+logger = cbpos.get_logger(__name__)
+
+def cache_location():
+    """
+    Returns the directory in which the caches are kept by default.
+    """
+    location = QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.CacheLocation)
+    if not location:
+        location = os.path.join(tempfile.gettempdir(), 'coinbox')
+    return location
+
+class FileCache(object):
+    """
+    Size-bounded on-disk cache of StoredFile contents, used to give them a path.
+
+    Entries are named after the content hash so they never go stale when the
+    content of a StoredFile changes, are written to a temporary file and then
+    renamed so that a crash never leaves a half-written entry behind, and are
+    evicted in least-recently-used order once the cache grows past `max_size`.
+    """
+
+    TEMP_PREFIX = '.tmp-'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.__lock = threading.RLock()
+        # name -> size, least recently used first
+        self.__entries = OrderedDict()
+        self.__total = 0
+        # Entries whose content was checked against the hash in this process
+        self.__verified = set()
+
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.__scan()
+
+    @classmethod
+    def from_config(cls):
+        directory = cbpos.config['cache', 'directory']
+        if not directory:
+            directory = os.path.join(cache_location(), 'files')
+
+        try:
+            max_size = int(cbpos.config['cache', 'max_size'])
+        except (ValueError, TypeError):
+            max_size = 0
+
+        logger.debug("File cache in %s (max %d bytes)", directory, max_size)
+        return cls(directory, max_size)
+
+    def __scan(self):
+        """
+        Rebuild the index from the directory, oldest entries first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(self.TEMP_PREFIX):
+                # Left behind by a crash while writing
+                self.__remove(path)
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+
+        for mtime, name, size in sorted(entries):
+            self.__entries[name] = size
+            self.__total += size
+
+        self.__evict()
+
+    def name_for(self, hash, filetype):
+        return '{}{}'.format(hash, filetype)
+
+    def path_for(self, hash, filetype):
+        return os.path.join(self.directory, self.name_for(hash, filetype))
+
+    def get(self, storedfile):
+        """
+        Returns the path of a valid cached copy of `storedfile`,
+        writing it if necessary.
+        """
+        name = self.name_for(storedfile.hash, storedfile.filetype)
+        path = os.path.join(self.directory, name)
+
+        with self.__lock:
+            if self.__is_valid(name, path, storedfile):
+                self.__touch(name, path)
+                return path
+
+            self.__discard(name)
+            self.__write(name, path, storedfile.iter_chunks())
+            self.__verified.add(name)
+            self.__evict()
+
+        return path
+
+    def __is_valid(self, name, path, storedfile):
+        if name not in self.__entries:
+            return False
+
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+
+        if size != storedfile.size:
+            return False
+
+        if name not in self.__verified:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(2**16), ''):
+                    digest.update(data)
+            if digest.hexdigest() != storedfile.hash:
+                logger.warn("Cached file %s is corrupted", path)
+                return False
+            self.__verified.add(name)
+
+        return True
+
+    def __touch(self, name, path):
+        self.__entries[name] = self.__entries.pop(name)
+        try:
+            # Keeps the order across restarts
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def __write(self, name, path, chunks):
+        fd, temp = tempfile.mkstemp(prefix=self.TEMP_PREFIX, dir=self.directory)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in chunks:
+                    f.write(data)
+                    size += len(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            if os.path.exists(path):
+                # Renaming over an existing file fails on Windows
+                os.remove(path)
+            os.rename(temp, path)
+        except:
+            self.__remove(temp)
+            raise
+
+        self.__entries[name] = size
+        self.__total += size
+
+    def __discard(self, name):
+        size = self.__entries.pop(name, None)
+        if size is not None:
+            self.__total -= size
+        self.__verified.discard(name)
+        self.__remove(os.path.join(self.directory, name))
+
+    def __evict(self):
+        if self.max_size <= 0:
+            return
+
+        while self.__total > self.max_size and len(self.__entries) > 1:
+            name = next(iter(self.__entries))
+            logger.debug("Evicting %s from the file cache", name)
+            self.__discard(name)
+
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def invalidate(self, hash=None):
+        """
+        Remove the entries with this content `hash`, or all of them.
+        """
+        with self.__lock:
+            for name in list(self.__entries):
+                if hash is None or name.startswith(hash):
+                    self.__discard(name)
+
+    @property
+    def total_size(self):
+        return self.__total
+
+manager = None
@@ -0,0 +1,142 @@
+"""
+ESC/POS commands, for thermal receipt printers which print text sent to them
+much faster than the rasterized pages of the system spooler.
+"""
+import socket
+import textwrap
+
+ESC = '\x1b'
+GS = '\x1d'
+
+LEFT, CENTER, RIGHT = 0, 1, 2
+
+DEFAULT_PORT = 9100
+
+def decode(text):
+    """
+    Returns `text` as unicode, byte strings being UTF-8.
+    """
+    if isinstance(text, str):
+        return text.decode('utf-8', 'replace')
+    return unicode(text)
+
+class EscPosWriter(object):
+    """
+    Builds the byte stream of receipts, `columns` characters wide,
+    cutting the paper after each of them if `cut` is set.
+    """
+
+    def __init__(self, columns=48, encoding='cp437', cut=True):
+        self.columns = columns
+        self.encoding = encoding
+        self.autocut = cut
+        self.__chunks = [ESC+'@']
+
+    def raw(self, data):
+        self.__chunks.append(data)
+
+    def encode(self, text):
+        return decode(text).encode(self.encoding, 'replace')
+
+    def text(self, text):
+        """
+        Prints `text`, wrapped to the width of the paper.
+        """
+        for line in decode(text).splitlines():
+            wrapped = textwrap.wrap(line, self.columns) or ['']
+            for part in wrapped:
+                self.raw(self.encode(part)+'\n')
+
+    def line(self, char='-'):
+        self.raw(char*self.columns+'\n')
+
+    def row(self, cells, widths, aligns=None):
+        """
+        Prints a row of cells, each cut to its width.
+        """
+        parts = []
+        for i, (cell, width) in enumerate(zip(cells, widths)):
+            cell = decode(cell)[:width]
+            align = aligns[i] if aligns is not None else LEFT
+            if align == RIGHT:
+                parts.append(cell.rjust(width))
+            elif align == CENTER:
+                parts.append(cell.center(width))
+            else:
+                parts.append(cell.ljust(width))
+        self.raw(self.encode(''.join(parts).rstrip())+'\n')
+
+    def table(self, num_cols, rows, headers=None, footers=None):
+        """
+        Prints a table of `num_cols` columns. The rows are printed as they
+        are read, so `rows` may be an iterator over any number of them.
+        """
+        widths = self.column_widths(num_cols, self.columns)
+        # Numbers are usually on the right
+        aligns = [LEFT] + [RIGHT]*(num_cols-1)
+
+        if headers is not None:
+            self.bold()
+            self.row(headers, widths, aligns)
+            self.bold(False)
+            self.line()
+
+        for row in rows:
+            self.row(row, widths, aligns)
+
+        if footers is not None:
+            self.line()
+            self.row(footers, widths, aligns)
+
+    def bold(self, on=True):
+        self.raw(ESC+'E'+chr(1 if on else 0))
+
+    def align(self, align=LEFT):
+        self.raw(ESC+'a'+chr(align))
+
+    def feed(self, lines=1):
+        self.raw(ESC+'d'+chr(lines))
+
+    def cut(self):
+        # Feed past the cutter, then partial cut
+        self.raw(GS+'V'+chr(66)+chr(0))
+
+    def end_job(self):
+        """
+        Ends a receipt, leaving room between it and the next one.
+        """
+        self.feed(3)
+        if self.autocut:
+            self.cut()
+
+    def getvalue(self):
+        return ''.join(self.__chunks)
+
+    @staticmethod
+    def column_widths(count, columns):
+        """
+        Splits `columns` characters between `count` table columns,
+        giving what remains to the first one.
+        """
+        if count <= 0:
+            return []
+        width = columns // count
+        return [columns - width*(count-1)] + [width]*(count-1)
+
+def send(device, data, timeout=10):
+    """
+    Sends `data` to the printer at `device`, which is either the path to its
+    device file (any file, to capture the output) or tcp://host[:port].
+    """
+    if device.startswith('tcp://'):
+        host, _, port = device[len('tcp://'):].partition(':')
+        port = int(port) if port else DEFAULT_PORT
+        conn = socket.create_connection((host, port), timeout)
+        try:
+            conn.sendall(data)
+        finally:
+            conn.close()
+    else:
+        with open(device, 'ab') as f:
+            f.write(data)
+            f.flush()
@@ -0,0 +1,163 @@
+import multiprocessing
+
+import cbpos
+logger = cbpos.get_logger(__name__)
+
+from cbmod.base import imaging
+
+def _error_message(e):
+    """
+    Returns the exception `e` as a unicode message, even when it was
+    raised with a non-ASCII byte string.
+    """
+    try:
+        message = unicode(e)
+    except UnicodeError:
+        message = repr(e)
+    return u'{}: {}'.format(type(e).__name__, message)
+
+def _process(args):
+    """
+    Runs in the worker processes. Exceptions are turned into messages
+    because they are not always picklable.
+    """
+    path, size, format, renditions = args
+    try:
+        return (path, imaging.process_image(path, size, format, renditions), None)
+    except Exception as e:
+        return (path, None, _error_message(e))
+
+class ImageImportResult(object):
+    def __init__(self):
+        # List of (path, StoredFile) for the imported images
+        self.files = []
+        # List of (path, error message) for the ones that failed
+        self.failures = []
+
+class ImageImporter(object):
+    """
+    Imports many images as StoredFile's at once. The images are resized and
+    converted in a pool of processes, and inserted in batches.
+    """
+
+    def __init__(self, size=None, format=None, renditions=None,
+                 processes=None, batch_size=50, progress=None):
+        from cbmod.base.models import StoredFile
+
+        self.size = size
+        self.format = format
+        self.renditions = StoredFile.RENDITION_SIZES if renditions is None else renditions
+        self.processes = processes
+        self.batch_size = batch_size
+        # Called as progress(done, total, path, error)
+        self.progress = progress
+
+    def run(self, sources):
+        """
+        Imports the images in `sources`, which are paths to image files or
+        to directories containing them. Returns an ImageImportResult.
+        """
+        from cbmod.base.models import StoredFile
+
+        paths = list(imaging.find_images(sources))
+        total = len(paths)
+        result = ImageImportResult()
+
+        logger.info("Importing %d images...", total)
+
+        tasks = [(path, self.size, self.format, self.renditions) for path in paths]
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            batch = []
+            done = 0
+            for path, processed, error in pool.imap_unordered(_process, tasks):
+                done += 1
+                if error is None:
+                    batch.append((path, StoredFile.from_encoded(*processed)))
+                else:
+                    logger.warn("Could not import %s: %s", path, error)
+                    result.failures.append((path, error))
+
+                if len(batch) >= self.batch_size:
+                    self.__commit(batch, result)
+                    batch = []
+
+                if self.progress is not None:
+                    self.progress(done, total, path, error)
+
+            self.__commit(batch, result)
+        finally:
+            pool.close()
+            pool.join()
+
+        logger.info("Imported %d images, %d failed", len(result.files), len(result.failures))
+        return result
+
+    def __commit(self, batch, result):
+        if not batch:
+            return
+
+        session = cbpos.database.session()
+        try:
+            session.add_all([f for path, f in batch])
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.exception("Could not insert %d images", len(batch))
+            result.failures.extend((path, _error_message(e)) for path, f in batch)
+        else:
+            result.files.extend(batch)
+
+def main(argv=None):
+    """
+    Console entry point: imports the images in the given files and directories.
+    """
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Import images into the Coinbox database.')
+    parser.add_argument('sources', nargs='+', metavar='PATH',
+                        help='image file or directory of images')
+    parser.add_argument('--size', nargs=2, type=int, metavar=('WIDTH', 'HEIGHT'),
+                        help='resize the images to fit in this size')
+    parser.add_argument('--format', help='convert the images to this format (e.g. png)')
+    parser.add_argument('--renditions', metavar='SIZES',
+                        help='comma-separated sizes of the renditions to generate')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help='number of images inserted per transaction')
+    args = parser.parse_args(argv)
+
+    size = None
+    if args.size is not None:
+        if min(args.size) <= 0:
+            parser.error('invalid size {}x{}'.format(*args.size))
+        size = tuple(args.size)
+
+    renditions = None
+    if args.renditions is not None:
+        try:
+            renditions = [int(s) for s in args.renditions.split(',') if s]
+        except ValueError:
+            parser.error('invalid renditions {}'.format(args.renditions))
+        if any(r <= 0 for r in renditions):
+            parser.error('invalid renditions {}'.format(args.renditions))
+
+    def progress(done, total, path, error):
+        status = 'failed' if error else 'ok'
+        sys.stdout.write('[{}/{}] {} {}\n'.format(done, total, path, status))
+
+    cbpos.loader.load_database()
+    from cbmod.base.models import migrations
+    migrations.upgrade()
+
+    importer = ImageImporter(size=size, format=args.format, renditions=renditions,
+                             processes=args.processes, batch_size=args.batch_size,
+                             progress=progress)
+    result = importer.run(args.sources)
+
+    for path, error in result.failures:
+        sys.stderr.write('{}: {}\n'.format(path, error.encode('utf-8')))
+
+    return 1 if result.failures else 0
@@ -1,6 +1,15 @@
+import Queue
+import numbers
+import itertools
+import threading
+from collections import OrderedDict
+
+from pydispatch import dispatcher
+from peak.util.proxies import LazyProxy
 from PySide import QtGui, QtCore
 
 import cbpos
+from cbmod.base.controllers import escpos
 
 logger = cbpos.get_logger(__name__)
 
@@ -10,18 +19,195 @@ class InvalidPrinterFunction(ValueError):
 class InvalidPrinterName(ValueError):
     pass
 
+class PrintQueue(object):
+    """
+    First in, first out queue of the jobs of one printer, which are printed
+    one after the other in a thread of their own. If text cannot be rendered
+    outside the GUI thread on this platform, they are printed from the event
+    loop instead, so that the caller still does not wait for them.
+    The outcome of every job is reported to the `notifier`.
+    """
+    
+    def __init__(self, name, notifier, threaded=True):
+        self.name = name
+        self.notifier = notifier
+        self.threaded = threaded
+        
+        self.__queue = Queue.Queue()
+        self.__lock = threading.Lock()
+        # Jobs queued or being printed
+        self.__pending = 0
+        self.__thread = None
+    
+    @property
+    def depth(self):
+        return self.__pending
+    
+    def put(self, printer, job):
+        with self.__lock:
+            self.__pending += 1
+        self.__queue.put((printer, job))
+        
+        if not self.threaded:
+            QtCore.QTimer.singleShot(0, self.__process_next)
+        elif self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run,
+                                             name='PrintQueue-{}'.format(self.name))
+            self.__thread.daemon = True
+            self.__thread.start()
+    
+    def stop(self, timeout=None):
+        """
+        Stops once the jobs already queued are printed, waiting for at most
+        `timeout` seconds for them. Without a thread, they are printed now,
+        as the event loop may not run again.
+        """
+        if not self.threaded:
+            while self.__process_next():
+                pass
+            return
+        
+        self.__queue.put(None)
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            self.__thread = None
+    
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            self.__execute(*item)
+    
+    def __process_next(self):
+        """
+        Prints the next job, returns False if there is none.
+        """
+        try:
+            item = self.__queue.get_nowait()
+        except Queue.Empty:
+            return False
+        self.__execute(*item)
+        return True
+    
+    def __execute(self, printer, job):
+        error = None
+        try:
+            printer.execute(job)
+        except Exception as e:
+            logger.exception('Print job %s failed on %s', job, self.name)
+            error = e
+        finally:
+            with self.__lock:
+                self.__pending -= 1
+        # Spooled jobs are reported by the spooler once they are sent
+        if error is not None or not printer.spooled:
+            self.notifier.finished.emit(self.name, job, error)
+
+class PrintNotifier(QtCore.QObject):
+    """
+    Sends the outcome of print jobs to the dispatcher from the GUI thread,
+    whichever thread they were printed in.
+    """
+    finished = QtCore.Signal(object, object, object)
+    
+    def __init__(self, sender):
+        super(PrintNotifier, self).__init__()
+        self.sender = sender
+        self.finished.connect(self.onFinished, QtCore.Qt.QueuedConnection)
+    
+    def onFinished(self, printer_name, job, error):
+        # The jobs merged in a batch are reported one by one,
+        # as they were handed to the manager
+        jobs = job.jobs if isinstance(job, BatchPrintJob) else [job]
+        for job in jobs:
+            if error is None:
+                dispatcher.send(signal='printing-job-done', sender=self.sender,
+                                job=job, printer=printer_name)
+            else:
+                dispatcher.send(signal='printing-job-failed', sender=self.sender,
+                                job=job, printer=printer_name, error=error)
+
 class PrinterManager(object):
     
     NoPrinter = -1
     
     def __init__(self):
-        pass
+        self.notifier = PrintNotifier(self)
+        # Printer name -> PrintQueue
+        self.__queues = {}
+        
+        # Registry of the printing configuration, loaded on first use
+        # Printer name -> serialized configuration
+        self.__serials = None
+        # Printer name -> Printer, deserialized once and reused for every job
+        self.__printers = {}
+        # Function name -> printer name, or NoPrinter
+        self.__functions = None
+        self.__default_printer = None
+        # The spooler loads printers from its own thread
+        self.__lock = threading.RLock()
+        
+        # Renders the jobs to files before printing them, see start_spooler
+        self.spooler = None
     
-    def prompt_printer(self, name, printer=None):
+    def start_spooler(self):
         """
-        Opens a dialog to let the user configure a printer.
+        Starts spooling the jobs if the printing.spool configuration is set,
+        and sends the jobs left in the spool.
         """
-        if printer is None:
+        if self.spooler is not None or not cbpos.config['printing', 'spool']:
+            return
+        from cbmod.base.controllers import spool
+        self.spooler = spool.Spooler.from_config(self.__load_spooled_printer,
+                                                 self.notifier.finished.emit)
+        self.spooler.start()
+    
+    def __load_spooled_printer(self, name):
+        if name == '[default]':
+            return self.get_default_printer()
+        return self.load_printer(name)
+    
+    def __load(self):
+        with self.__lock:
+            if self.__serials is not None:
+                return
+            
+            serials = OrderedDict()
+            functions = OrderedDict()
+            for key in cbpos.config['printing']:
+                value = cbpos.config['printing', key]
+                if value is None:
+                    # Removed
+                    continue
+                if key.startswith('p.'):
+                    serials[key[2:]] = value
+                elif key.startswith('f.'):
+                    functions[key[2:]] = value
+            
+            self.__serials = serials
+            self.__functions = functions
+            self.__printers = {}
+    
+    def reload(self):
+        """
+        Forget the configuration of the printers, for it to be read again
+        the next time it is needed.
+        """
+        with self.__lock:
+            self.__serials = None
+            self.__functions = None
+            self.__printers = {}
+            self.__default_printer = None
+    
+    def prompt_printer(self, name, printer=None, backend='qt'):
+        """
+        Opens a dialog to let the user configure a printer of the `backend`,
+        starting from the settings of `printer` if it is of the same backend.
+        """
+        if backend == 'escpos':
+            return self.prompt_escpos_printer(name, printer)
+        elif printer is None or printer.backend != backend:
             qprinter = QtGui.QPrinter()
         else:
             # TODO: On Windows (at least), the copy count is not showing in the dialog
@@ -38,6 +224,20 @@ class PrinterManager(object):
             
             return Printer(name, qprinter)
     
+    def prompt_escpos_printer(self, name, printer=None):
+        """
+        Opens a dialog to let the user configure an ESC/POS printer,
+        by the path to its device or its network address.
+        """
+        device = printer.device if isinstance(printer, EscPosPrinter) else ''
+        device, ok = QtGui.QInputDialog.getText(cbpos.ui.window, cbpos.tr.base_("ESC/POS Printer"),
+                                    cbpos.tr.base_("Device file, or tcp://host:port:"),
+                                    QtGui.QLineEdit.Normal, device)
+        if ok and device:
+            if isinstance(printer, EscPosPrinter):
+                return EscPosPrinter(name, device, printer.columns, printer.encoding, printer.cut)
+            return EscPosPrinter(name, device)
+    
     def select_printer(self):
         """
         Opens a dialog to let the user select
@@ -58,36 +258,55 @@ class PrinterManager(object):
         """
         Save the printer configuration under this `name`.
         """
-        cbpos.config['printing', 'p.'+printer.name] = printer.serialized()
+        with self.__lock:
+            self.__load()
+            serial = printer.serialized()
+            cbpos.config['printing', 'p.'+printer.name] = serial
+            self.__serials[printer.name] = serial
+            self.__printers[printer.name] = printer
         return printer
     
     def remove_printer(self, printer):
-        cbpos.config['printing', 'p.'+printer.name] = None
+        with self.__lock:
+            self.__load()
+            cbpos.config['printing', 'p.'+printer.name] = None
+            self.__serials.pop(printer.name, None)
+            self.__printers.pop(printer.name, None)
     
     def load_printer(self, name):
         """
         Load the printer configuration under this `name`.
         """
-        serial = cbpos.config['printing', 'p.'+name]
-        if serial is None:
-            raise InvalidPrinterName, 'Does not exist'
-        
-        printer = Printer(name, serial)
-        return printer
+        with self.__lock:
+            try:
+                return self.__printers[name]
+            except KeyError:
+                pass
+            
+            self.__load()
+            try:
+                serial = self.__serials[name]
+            except KeyError:
+                raise InvalidPrinterName, 'Does not exist'
+            
+            printer = self.__printers[name] = Printer.from_serialized(name, serial)
+            return printer
     
     def get_printer_names(self):
-        return [p[2:] for p in cbpos.config['printing'] if p.startswith('p.')]
+        self.__load()
+        return list(self.__serials)
     
     def register_function(self, function):
         """
         Register this printer function, so that the user can configure
         a printer to use for that function.
         """
-        p = cbpos.config['printing', 'f.'+function]
-        if p is not None:
+        self.__load()
+        if function in self.__functions:
             return
         
         cbpos.config['printing', 'f.'+function] = PrinterManager.NoPrinter
+        self.__functions[function] = PrinterManager.NoPrinter
     
     def set_function_printer(self, function, printer):
         """
@@ -96,13 +315,13 @@ class PrinterManager(object):
         If `printer_name` is None, always ask the user
         to select the printer to use.
         """
-        if printer is None:
-            cbpos.config['printing', 'f.'+function] = PrinterManager.NoPrinter
-        else:
-            cbpos.config['printing', 'f.'+function] = printer.name
+        self.__load()
+        value = PrinterManager.NoPrinter if printer is None else printer.name
+        cbpos.config['printing', 'f.'+function] = value
+        self.__functions[function] = value
     
     def get_function_printer(self, function):
-        printer = cbpos.config['printing', 'f.'+function]
+        printer = self.get_function_printer_name(function)
         if printer == PrinterManager.NoPrinter:
             return None
         elif printer is None:
@@ -111,11 +330,19 @@ class PrinterManager(object):
             return self.load_printer(printer)
     
     def get_function_printer_name(self, function):
-        printer = cbpos.config['printing', 'f.'+function]
-        return printer
+        self.__load()
+        return self.__functions.get(function)
     
     def get_function_names(self):
-        return [f[2:] for f in cbpos.config['printing'] if f.startswith('f.')]
+        self.__load()
+        return list(self.__functions)
+    
+    def get_printer_functions(self, name):
+        """
+        Returns the names of the functions which use the printer `name`.
+        """
+        self.__load()
+        return [f for f, p in self.__functions.iteritems() if p == name]
     
     def get_default_printer(self):
         """
@@ -123,38 +350,133 @@ class PrinterManager(object):
         """
         printer_name = cbpos.config['printing', 'default']
         if printer_name is None:
-            return Printer('[default]', QtGui.QPrinter())
+            with self.__lock:
+                if self.__default_printer is None:
+                    self.__default_printer = Printer('[default]', QtGui.QPrinter())
+                return self.__default_printer
         else:
             return self.load_printer(printer_name)
     
+    def resolve_printer(self, function):
+        """
+        Returns the printer to use for this function, or None if there is
+        none to use.
+        """
+        if function is None:
+            return self.get_default_printer()
+        
+        try:
+            printer = self.get_function_printer(function)
+        except (InvalidPrinterFunction, InvalidPrinterName):
+            # Configuration error
+            return None
+        
+        if printer is None:
+            try:
+                printer = self.select_printer()
+            except InvalidPrinterName:
+                # User did not select a printer
+                return None
+        return printer
+    
     def handle(self, job, function):
         """
         Handle a print job depending on the function and configuration
         of the printers and printer manager.
         """
-        if function is None:
-            printer = self.get_default_printer()
-        else:
-            try:
-                printer = self.get_function_printer(function)
-            except (InvalidPrinterFunction, InvalidPrinterName):
-                # Configuration error
-                return
-            
-            if printer is None:
-                try:
-                    printer = self.select_printer()
-                except InvalidPrinterName:
-                    # User did not select a printer
-                    return
+        printer = self.resolve_printer(function)
+        if printer is not None:
+            self.print_job(printer, job)
+    
+    def handle_many(self, jobs, function):
+        """
+        Handle many print jobs at once, for the same function. The printer
+        is only looked up once, and consecutive jobs that can be merged are
+        printed as a single document, each starting on a new page.
+        When queued, the outcome is still sent for each of `jobs`.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+        
+        printer = self.resolve_printer(function)
+        if printer is None:
+            return
         
+        for job in BatchPrintJob.merge(jobs):
+            self.print_job(printer, job)
+    
+    def print_job(self, printer, job):
         preview = cbpos.config['printing', 'force_preview']
+        if not preview and self.spooler is not None:
+            from cbmod.base.controllers import spool
+            printer = spool.SpoolPrinter(printer, self.spooler)
+        
         if preview:
             printer.preview(job)
+        elif cbpos.config['printing', 'async']:
+            self.enqueue(printer, job)
         else:
-            printer.execute(job)
+            # Reported as the queued jobs are, and raised to the caller
+            try:
+                printer.execute(job)
+            except Exception as e:
+                self.notifier.onFinished(printer.name, job, e)
+                raise
+            if not printer.spooled:
+                self.notifier.onFinished(printer.name, job, None)
+    
+    def enqueue(self, printer, job):
+        """
+        Queue the job to be printed in the background, after the other jobs
+        of the same printer. Its outcome is sent with the 'printing-job-done'
+        or 'printing-job-failed' signals, nothing is raised to the caller.
+        The content of the job is built in the print thread, so it must not
+        read anything bound to the GUI thread (e.g. objects of its session).
+        This is why handle only queues jobs if printing.async is enabled.
+        """
+        try:
+            queue = self.__queues[printer.name]
+        except KeyError:
+            try:
+                threaded = QtGui.QFontDatabase.supportsThreadedFontRendering()
+            except AttributeError:
+                threaded = False
+            queue = self.__queues[printer.name] = PrintQueue(printer.name, self.notifier, threaded)
+        queue.put(printer, job)
+    
+    def queue_depth(self, printer_name=None):
+        """
+        Returns the number of jobs queued or being printed, on the printer
+        `printer_name` or on all of them.
+        """
+        if printer_name is None:
+            return sum(q.depth for q in self.__queues.itervalues())
+        try:
+            return self.__queues[printer_name].depth
+        except KeyError:
+            return 0
+    
+    def queue_depths(self):
+        return dict((name, q.depth) for name, q in self.__queues.iteritems())
+    
+    def shutdown(self, timeout=10):
+        """
+        Waits for the queued jobs to be printed, for at most `timeout`
+        seconds per printer.
+        """
+        queues, self.__queues = self.__queues, {}
+        for queue in queues.itervalues():
+            queue.stop(timeout)
+        
+        if self.spooler is not None:
+            self.spooler.stop(timeout)
 
 class Printer(object):
+    backend = 'qt'
+    # Whether printing a job only spools it, see spool.SpoolPrinter
+    spooled = False
+    
     def __init__(self, name, qprinter):
         self.name = name
         if isinstance(qprinter, QtGui.QPrinter):
@@ -162,6 +484,18 @@ class Printer(object):
         else:
             self.qprinter = self.deserialized(qprinter)
     
+    @staticmethod
+    def from_serialized(name, serial):
+        """
+        Returns a printer of the backend it was saved with.
+        """
+        backend = serial.get('backend', Printer.backend)
+        try:
+            cls = backends[backend]
+        except KeyError:
+            raise InvalidPrinterName, 'Unknown backend {}'.format(backend)
+        return cls(name, serial)
+    
     def preview(self, job):
         preview = QtGui.QPrintPreviewDialog(self.qprinter)
         preview.paintRequested.connect(job.handler)
@@ -174,7 +508,8 @@ class Printer(object):
         qp = self.qprinter
         unit = QtGui.QPrinter.Millimeter
         
-        return {'name': qp.printerName(),
+        return {'backend': self.backend,
+                'name': qp.printerName(),
                 'unit': int(unit),
                 
                 'orientation': int(qp.orientation()),
@@ -233,9 +568,151 @@ class Printer(object):
         
         return qp
 
+class EscPosPrinter(Printer):
+    """
+    Receipt printer which is sent ESC/POS commands directly, instead of
+    going through the system spooler. See escpos.send for `device`.
+    """
+    backend = 'escpos'
+    
+    def __init__(self, name, device, columns=48, encoding='cp437', cut=True):
+        self.name = name
+        self.qprinter = None
+        if isinstance(device, dict):
+            s = device
+            device = s['device']
+            columns = s.get('columns', columns)
+            encoding = s.get('encoding', encoding)
+            cut = s.get('cut', cut)
+        self.device = device
+        self.columns = int(columns)
+        self.encoding = encoding
+        self.cut = bool(cut)
+    
+    def preview(self, job):
+        # Previews what would be printed through the spooler
+        Printer(self.name, QtGui.QPrinter()).preview(job)
+    
+    def render(self, job):
+        """
+        Returns the ESC/POS byte stream of the job.
+        """
+        writer = escpos.EscPosWriter(self.columns, self.encoding, self.cut)
+        job.escpos(writer)
+        writer.end_job()
+        return writer.getvalue()
+    
+    def execute(self, job):
+        escpos.send(self.device, self.render(job))
+    
+    def serialized(self):
+        return {'backend': self.backend,
+                'device': self.device,
+                'columns': self.columns,
+                'encoding': self.encoding,
+                'cut': self.cut
+                }
+
+backends = {Printer.backend: Printer,
+            EscPosPrinter.backend: EscPosPrinter
+            }
+
 class PrintJob(object):
     def handler(self, qprinter):
         pass
+    
+    def escpos(self, writer):
+        """
+        Writes the job to the EscPosWriter `writer`, for ESC/POS printers.
+        """
+        pass
+
+class DocTemplate(object):
+    """
+    The static parts of a document: its header and footer, around the
+    empty main frame in which the content of every job is inserted.
+    """
+    
+    def __init__(self, job):
+        self.doc = QtGui.QTextDocument()
+        
+        # Let the job insert its header and footer into the template
+        job.doc = self.doc
+        job.cursor = QtGui.QTextCursor(self.doc)
+        
+        # Seek to start
+        job.cursor.movePosition(QtGui.QTextCursor.Start)
+        
+        # Insert header
+        job.insert_header()
+        
+        # Create main frame underneath
+        fmt = QtGui.QTextFrameFormat()
+        main_frame = job.cursor.insertFrame(fmt)
+        self.content_position = main_frame.firstPosition()
+        
+        # Seek out of main frame, to the end
+        job.cursor.setPosition(main_frame.lastPosition())
+        job.cursor.movePosition(QtGui.QTextCursor.NextBlock)
+        job.cursor.movePosition(QtGui.QTextCursor.End)
+        
+        # Insert footer
+        job.insert_footer()
+        
+        job.doc = job.cursor = None
+    
+    def instantiate(self):
+        """
+        Returns a new document, copy of the template, and its main frame.
+        """
+        doc = self.doc.clone()
+        return doc, doc.frameAt(self.content_position)
+
+class DocTemplateCache(object):
+    """
+    Least recently used cache of the templates of the jobs, by job class,
+    template key and page size.
+    """
+    
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.__templates = OrderedDict()
+        # Jobs are printed from several threads
+        self.__lock = threading.Lock()
+    
+    @staticmethod
+    def page_key(qprinter):
+        if qprinter is None:
+            return None
+        rect = qprinter.pageRect()
+        return (rect.width(), rect.height(), qprinter.resolution())
+    
+    def instantiate(self, job, qprinter=None):
+        """
+        Returns a new document for the job, with its header and footer,
+        and its main frame.
+        """
+        template_key = job.template_key()
+        if template_key is None:
+            return DocTemplate(job).instantiate()
+        
+        key = (type(job), template_key, self.page_key(qprinter))
+        with self.__lock:
+            template = self.__templates.pop(key, None)
+            if template is None:
+                template = DocTemplate(job)
+            self.__templates[key] = template
+            while len(self.__templates) > self.max_size:
+                self.__templates.popitem(last=False)
+            
+            # Cloning reads the template, which is not thread-safe either
+            return template.instantiate()
+    
+    def clear(self):
+        with self.__lock:
+            self.__templates.clear()
+
+templates = DocTemplateCache()
 
 class DocPrintJob(PrintJob):
     header = ""
@@ -246,12 +723,25 @@ class DocPrintJob(PrintJob):
         self.doc = None
         self.cursor = None
     
+    def template_key(self):
+        """
+        Identifies the header and footer of the job, which are only inserted
+        once in a template for all the jobs with the same key.
+        Returns None, for them to be inserted for every job, if a subclass
+        inserts them differently without overriding this.
+        """
+        cls = type(self)
+        if cls.insert_header.__func__ not in _template_methods or \
+                cls.insert_footer.__func__ not in _template_methods:
+            return None
+        return (self.header, self.footer)
+    
     def insert_header(self):
         self.cursor.insertText(self.header)
         self.cursor.insertText("\n\n")
     
     def insert_content(self):
-        self.cursor.insertText(content)
+        self.cursor.insertText(self.content)
     
     def insert_footer(self):
         self.cursor.insertText("\n\n")
@@ -262,39 +752,84 @@ class DocPrintJob(PrintJob):
         
         self.cursor.insertText(self.footer)
     
-    def handler(self, qprinter):
-        # Create new document
-        self.doc = QtGui.QTextDocument()
+    def build(self, qprinter=None):
+        """
+        Returns the document to print: a copy of the template with the
+        header and footer, in which the content is inserted.
+        """
+        self.doc, self.main_frame = templates.instantiate(self, qprinter)
         self.cursor = QtGui.QTextCursor(self.doc)
         
-        # Seek to start
-        self.cursor.movePosition(QtGui.QTextCursor.Start)
-        
-        # Insert header
-        self.insert_header()
-        
-        # Create main frame underneath
-        fmt = QtGui.QTextFrameFormat()
-        self.main_frame = self.cursor.insertFrame(fmt)
-        
         # Seek into main frame
         self.cursor.setPosition(self.main_frame.firstPosition())
         
         # Insert content
         self.insert_content()
         
-        # Seek out of main frame
-        self.cursor.setPosition(self.main_frame.lastPosition())
-        self.cursor.movePosition(QtGui.QTextCursor.NextBlock)
-        
-        # Seek to end
-        self.cursor.movePosition(QtGui.QTextCursor.End)
-        
-        # Insert footer
-        self.insert_footer()
+        return self.doc
+    
+    def handler(self, qprinter):
+        self.build(qprinter)
         
         # Print the document
         self.doc.print_(qprinter)
+    
+    def escpos(self, writer):
+        if self.template_key() is None:
+            # Header and footer are inserted in some other way,
+            # print the whole document as text
+            writer.text(self.build().toPlainText())
+            return
+        
+        writer.text(self.header)
+        writer.feed(2)
+        
+        self.escpos_content(writer)
+        
+        writer.feed(2)
+        writer.align(escpos.CENTER)
+        writer.text(self.footer)
+        writer.align()
+    
+    def escpos_content(self, writer):
+        writer.text(self.content)
+
+class TableFormats(object):
+    """
+    The formats used by TablePrintJob, which are the same for all the tables.
+    """
+    
+    def __init__(self):
+        self.table = QtGui.QTextTableFormat()
+        self.table.setBorder(0)
+        self.table.setWidth(QtGui.QTextLength(QtGui.QTextLength.PercentageLength, 100))
+        
+        self.header = QtGui.QTextCharFormat()
+        self.header.setFontUnderline(False)
+        self.header.setFontWeight(QtGui.QFont.Black)
+        
+        self.footer = QtGui.QTextCharFormat()
+        self.footer.setFontUnderline(False)
+        self.footer.setFontItalic(True)
+        
+        self.line = QtGui.QTextFrameFormat()
+        self.line.setBorder(1)
+        self.line.setBorderStyle(QtGui.QTextFrameFormat.BorderStyle_Inset)
+        self.line.setMargin(0)
+        self.line.setPadding(0)
+        self.line.setHeight(QtGui.QTextLength(QtGui.QTextLength.FixedLength, 0))
+        self.line.setWidth(QtGui.QTextLength(QtGui.QTextLength.PercentageLength, 100))
+        self.line.setPosition(QtGui.QTextFrameFormat.FloatRight)
+    
+    __instance = None
+    __lock = threading.Lock()
+    
+    @classmethod
+    def get(cls):
+        with cls.__lock:
+            if cls.__instance is None:
+                cls.__instance = cls()
+            return cls.__instance
 
 class TablePrintJob(DocPrintJob):
     def __init__(self, data=None, headers=None, footers=None):
@@ -324,26 +859,11 @@ class TablePrintJob(DocPrintJob):
         if self.table_footers is not None:
             extra_rows += 1
         
-        table_fmt = QtGui.QTextTableFormat()
-        table_fmt.setBorder(0)
-        table_fmt.setWidth(QtGui.QTextLength(QtGui.QTextLength.PercentageLength, 100))
-        
-        header_fmt = QtGui.QTextCharFormat()
-        header_fmt.setFontUnderline(False)
-        header_fmt.setFontWeight(QtGui.QFont.Black)
-        
-        footer_fmt = QtGui.QTextCharFormat()
-        footer_fmt.setFontUnderline(False)
-        footer_fmt.setFontItalic(True)
-        
-        line_fmt = QtGui.QTextFrameFormat()
-        line_fmt.setBorder(1)
-        line_fmt.setBorderStyle(QtGui.QTextFrameFormat.BorderStyle_Inset)
-        line_fmt.setMargin(0)
-        line_fmt.setPadding(0)
-        line_fmt.setHeight(QtGui.QTextLength(QtGui.QTextLength.FixedLength, 0))
-        line_fmt.setWidth(QtGui.QTextLength(QtGui.QTextLength.PercentageLength, 100))
-        line_fmt.setPosition(QtGui.QTextFrameFormat.FloatRight)
+        formats = TableFormats.get()
+        table_fmt = formats.table
+        header_fmt = formats.header
+        footer_fmt = formats.footer
+        line_fmt = formats.line
         
         def insertLine():
             """
@@ -405,19 +925,295 @@ class TablePrintJob(DocPrintJob):
         # Seek out of the table, just in case
         self.cursor.movePosition(QtGui.QTextCursor.NextBlock)
 
+    def table_columns(self):
+        return table_columns(self.table_data, self.table_headers, self.table_footers)
+    
+    def escpos_content(self, writer):
+        num_cols, rows = self.table_columns()
+        writer.table(num_cols, rows, self.table_headers, self.table_footers)
+
+def table_columns(data, headers=None, footers=None):
+    """
+    Returns the number of columns of a table, and its rows.
+    Only the first row is looked at if the rows are an iterator.
+    """
+    num_cols = 0
+    rows = data if data is not None else []
+    if hasattr(rows, '__len__'):
+        num_cols = max([len(d) for d in rows] or [0])
+    else:
+        rows = iter(rows)
+        try:
+            first = next(rows)
+        except StopIteration:
+            pass
+        else:
+            num_cols = len(first)
+            rows = itertools.chain([first], rows)
+    
+    for extra in (headers, footers):
+        if extra is not None:
+            num_cols = max(num_cols, len(extra))
+    return num_cols, rows
+
+class StreamingTablePrintJob(PrintJob):
+    """
+    Table printed straight to the printer, page by page, with its column
+    headers repeated on every page. Rows are painted as they are read, so
+    that tables of any length are printed in bounded memory.
+    `data` is an iterable of rows, or a callable returning one, for the job
+    to be printed more than once (e.g. previewed, then printed).
+    `columns` are the relative widths of the columns, which are all the same
+    width by default. Columns past the end of `columns` get a width of 1.
+    """
+    header = ""
+    footer = ""
+    
+    # Space between two rows, relative to the height of a line
+    row_spacing = 0.25
+    
+    def __init__(self, data=None, headers=None, footers=None, columns=None):
+        self.table_data = data
+        self.table_headers = headers
+        self.table_footers = footers
+        self.column_weights = columns
+        
+        # Number of pages printed by the last handler call
+        self.pages = 0
+    
+    def rows(self):
+        data = self.table_data
+        if data is None:
+            return iter(())
+        elif callable(data):
+            data = data()
+        return iter(data)
+    
+    def table_columns(self):
+        return table_columns(self.rows(), self.table_headers, self.table_footers)
+    
+    def handler(self, qprinter):
+        painter = QtGui.QPainter()
+        if not painter.begin(qprinter):
+            raise IOError('Could not print on {}'.format(qprinter.printerName()))
+        try:
+            table_painter = TablePainter(self, painter, qprinter)
+            table_painter.paint()
+            self.pages = table_painter.pages
+        finally:
+            painter.end()
+    
+    def escpos(self, writer):
+        writer.text(self.header)
+        writer.feed(2)
+        
+        num_cols, rows = self.table_columns()
+        writer.table(num_cols, rows, self.table_headers, self.table_footers)
+        
+        writer.feed(2)
+        writer.align(escpos.CENTER)
+        writer.text(self.footer)
+        writer.align()
+
+class TablePainter(object):
+    """
+    Paints a StreamingTablePrintJob on the pages of a printer.
+    """
+    
+    PADDING = 2
+    
+    def __init__(self, job, painter, qprinter):
+        self.job = job
+        self.painter = painter
+        self.qprinter = qprinter
+        
+        page = qprinter.pageRect()
+        self.width = page.width()
+        self.height = page.height()
+        
+        self.font = QtGui.QFont(painter.font())
+        self.header_font = QtGui.QFont(self.font)
+        self.header_font.setWeight(QtGui.QFont.Black)
+        self.footer_font = QtGui.QFont(self.font)
+        self.footer_font.setItalic(True)
+        
+        self.line_height = QtGui.QFontMetrics(self.font, qprinter).height()
+        self.row_height = int(self.line_height * (1 + job.row_spacing))
+        self.pen_width = max(1, qprinter.resolution() // 150)
+        
+        self.pages = 1
+        self.y = 0
+    
+    def paint(self):
+        job = self.job
+        num_cols, rows = job.table_columns()
+        
+        # The columns without a weight get 1
+        weights = list(job.column_weights or [])[:num_cols]
+        weights += [1]*(num_cols - len(weights))
+        total = float(sum(weights)) or 1.0
+        self.edges = [int(round(self.width * sum(weights[:i]) / total)) for i in xrange(num_cols+1)]
+        
+        if job.header:
+            self.paint_text(job.header, self.font, QtCore.Qt.AlignLeft)
+            self.y += self.line_height
+        
+        self.paint_headers()
+        
+        for row in rows:
+            if self.y + self.row_height > self.height:
+                self.new_page()
+                self.paint_headers()
+            self.paint_row(row, self.font)
+        
+        if job.table_footers is not None:
+            if self.y + self.pen_width + self.row_height > self.height:
+                self.new_page()
+            self.paint_line()
+            self.paint_row(job.table_footers, self.footer_font)
+        
+        if job.footer:
+            self.y += self.line_height
+            self.paint_text(job.footer, self.font, QtCore.Qt.AlignHCenter)
+    
+    def new_page(self):
+        self.qprinter.newPage()
+        self.pages += 1
+        self.y = 0
+    
+    def paint_line(self):
+        pen = QtGui.QPen(self.painter.pen())
+        pen.setWidth(self.pen_width)
+        self.painter.setPen(pen)
+        self.painter.drawLine(0, self.y, self.width, self.y)
+        self.y += self.pen_width
+    
+    def paint_headers(self):
+        if self.job.table_headers is not None:
+            self.paint_row(self.job.table_headers, self.header_font)
+            self.paint_line()
+    
+    def paint_row(self, cells, font):
+        self.painter.setFont(font)
+        metrics = self.painter.fontMetrics()
+        for c, cell in enumerate(itertools.islice(cells, len(self.edges)-1)):
+            left = self.edges[c] + self.PADDING
+            width = self.edges[c+1] - self.edges[c] - 2*self.PADDING
+            # Numbers are aligned on the right
+            align = QtCore.Qt.AlignRight if isinstance(cell, numbers.Number) else QtCore.Qt.AlignLeft
+            text = metrics.elidedText(unicode(cell), QtCore.Qt.ElideRight, width)
+            self.painter.drawText(QtCore.QRect(left, self.y, width, self.row_height),
+                                  align | QtCore.Qt.AlignVCenter, text)
+        self.y += self.row_height
+    
+    def paint_text(self, text, font, align):
+        self.painter.setFont(font)
+        flags = align | QtCore.Qt.TextWordWrap
+        rect = self.painter.boundingRect(QtCore.QRect(0, 0, self.width, self.height), flags, text)
+        if self.y > 0 and self.y + rect.height() > self.height:
+            self.new_page()
+        self.painter.drawText(QtCore.QRect(0, self.y, self.width, rect.height()), flags, text)
+        self.y += rect.height()
+
 class HTMLPrintJob(DocPrintJob):
     def insert_header(self):
         self.cursor.insertHtml(self.header)
         self.cursor.insertText("\n\n")
     
     def insert_content(self):
-        self.cursor.insertHtml(content)
+        self.cursor.insertHtml(self.content)
     
     def insert_footer(self):
         self.cursor.insertText("\n\n")
         self.cursor.insertHtml(self.footer)
+    
+    def escpos(self, writer):
+        # Let Qt turn the HTML into text
+        writer.text(self.build().toPlainText())
+
+class BatchPrintJob(PrintJob):
+    """
+    Several DocPrintJob's printed as one document, each starting on a new page,
+    or as one stream of receipts on ESC/POS printers.
+    """
+    
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+        self.doc = None
+    
+    @classmethod
+    def merge(cls, jobs):
+        """
+        Returns the jobs to print instead of `jobs`, in which the consecutive
+        DocPrintJob's are merged, see `mergeable`.
+        """
+        merged = []
+        batch = []
+        for job in itertools.chain(jobs, [None]):
+            if cls.mergeable(job):
+                batch.append(job)
+                continue
+            
+            if len(batch) == 1:
+                merged.append(batch[0])
+            elif batch:
+                merged.append(cls(batch))
+            batch = []
+            
+            if job is not None:
+                merged.append(job)
+        return merged
+    
+    @staticmethod
+    def mergeable(job):
+        """
+        Whether the job can be printed in a batch: a DocPrintJob which
+        prints its document as built, like the base class does. Those which
+        print themselves in some other way are printed on their own.
+        """
+        if not isinstance(job, DocPrintJob):
+            return False
+        cls = type(job)
+        return cls.handler.__func__ is DocPrintJob.handler.__func__ and \
+                cls.build.__func__ is DocPrintJob.build.__func__
+    
+    def build(self, qprinter=None):
+        self.doc = QtGui.QTextDocument()
+        cursor = QtGui.QTextCursor(self.doc)
+        
+        for i, job in enumerate(self.jobs):
+            if i > 0:
+                cursor.insertBlock()
+            start = cursor.position()
+            
+            cursor.insertFragment(QtGui.QTextDocumentFragment(job.build(qprinter)))
+            
+            if i > 0:
+                # Start each job on a new page
+                block_cursor = QtGui.QTextCursor(self.doc.findBlock(start))
+                fmt = block_cursor.blockFormat()
+                fmt.setPageBreakPolicy(QtGui.QTextFormat.PageBreak_AlwaysBefore)
+                block_cursor.setBlockFormat(fmt)
+        
+        return self.doc
+    
+    def handler(self, qprinter):
+        self.build(qprinter)
+        self.doc.print_(qprinter)
+    
+    def escpos(self, writer):
+        for i, job in enumerate(self.jobs):
+            if i > 0:
+                writer.end_job()
+            job.escpos(writer)
+
+# The ways of inserting headers and footers that only depend on the
+# `header` and `footer` attributes, see DocPrintJob.template_key
+_template_methods = frozenset(f.__func__ for f in (DocPrintJob.insert_header, DocPrintJob.insert_footer,
+                                                   HTMLPrintJob.insert_header, HTMLPrintJob.insert_footer))
 
-manager = None
+# Created the first time it is used
+manager = LazyProxy(PrinterManager)
 
 from cbmod.base.controllers import FormController
 
@@ -482,4 +1278,4 @@ class PrinterFormController(FormController):
         elif field == 'info':
             return item.printer
         elif field == 'functions':
-            return [f for f in manager.get_function_names() if manager.get_function_printer_name(f) == item.display]
+            return manager.get_printer_functions(item.display)
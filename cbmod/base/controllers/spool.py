@@ -0,0 +1,392 @@
+"""
+Print spool: jobs are rendered to files in a local directory first, then
+sent to the printers by a thread of their own. Jobs are not lost if a printer
+is stuck or fails, they are sent again later, even after a restart.
+"""
+import os
+import sys
+import time
+import errno
+import shutil
+import urllib
+import tempfile
+import threading
+import subprocess
+
+from PySide import QtGui
+
+import cbpos
+logger = cbpos.get_logger(__name__)
+
+from cbmod.base.controllers import escpos
+from cbmod.base.controllers.printing import InvalidPrinterName
+
+def spool_location():
+    """
+    Returns the directory of the spool by default.
+    """
+    location = QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.DataLocation)
+    if not location:
+        location = os.path.join(tempfile.gettempdir(), 'coinbox')
+    return os.path.join(location, 'spool')
+
+class SpoolPrinter(object):
+    """
+    Stands for `printer`: printing a job only renders it to the spool, from
+    which the spooler thread sends it to `printer`. The job is rendered in
+    the thread that prints it, which is the caller's unless printing.async
+    is set. Its outcome is reported by the spooler once it is sent.
+    """
+
+    # The outcome of the jobs is not known once they are printed here
+    spooled = True
+
+    def __init__(self, printer, spooler):
+        self.printer = printer
+        self.spooler = spooler
+        self.name = printer.name
+
+    def preview(self, job):
+        self.printer.preview(job)
+
+    def execute(self, job):
+        self.spooler.spool(self.printer, job)
+
+class Spooler(object):
+    """
+    Files waiting to be sent are in `directory`, named after the time they
+    were spooled and their printer. Once sent, they are moved to its 'done'
+    subdirectory, where the last `keep` of them are kept to be reprinted.
+    Sending is retried every `retry` seconds, and files which could not be
+    sent after `attempts` tries, or whose printer does not exist anymore,
+    are moved to its 'failed' subdirectory.
+    `load_printer` returns the printer of the given name. `notify` is called
+    from the spooler thread as notify(printer_name, job, error) once a job
+    spooled since the start is sent or given up on, with the exception
+    raised in the latter case.
+    """
+
+    TEMP_PREFIX = '.tmp-'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, directory, load_printer, keep=100, retry=10, attempts=5, notify=None):
+        self.directory = directory
+        self.load_printer = load_printer
+        self.keep = keep
+        self.retry = retry
+        self.attempts = attempts
+        self.notify = notify
+
+        # File name -> number of failed attempts to send it
+        self.__failures = {}
+        # File name -> job it was rendered from, to report its outcome
+        self.__jobs = {}
+        self.__lock = threading.Lock()
+        self.__sequence = 0
+        self.__wakeup = threading.Event()
+        self.__stopped = False
+        self.__thread = None
+
+        for d in (self.directory, self.done_directory, self.failed_directory):
+            try:
+                os.makedirs(d)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Left behind by a crash while rendering
+        for name in os.listdir(self.directory):
+            if name.startswith(self.TEMP_PREFIX):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    @classmethod
+    def from_config(cls, load_printer, notify=None):
+        directory = cbpos.config['printing', 'spool_directory'] or spool_location()
+        try:
+            keep = int(cbpos.config['printing', 'spool_keep'])
+        except (ValueError, TypeError):
+            keep = 100
+        try:
+            retry = int(cbpos.config['printing', 'spool_retry'])
+        except (ValueError, TypeError):
+            retry = 10
+        try:
+            attempts = int(cbpos.config['printing', 'spool_attempts'])
+        except (ValueError, TypeError):
+            attempts = 5
+        logger.debug("Print spool in %s", directory)
+        return cls(directory, load_printer, keep, retry, attempts, notify)
+
+    @property
+    def done_directory(self):
+        return os.path.join(self.directory, self.DONE)
+
+    @property
+    def failed_directory(self):
+        return os.path.join(self.directory, self.FAILED)
+
+    def file_name(self, printer_name, extension):
+        with self.__lock:
+            self.__sequence += 1
+            sequence = self.__sequence
+        return '{:015d}-{:06d}-{}.{}'.format(int(time.time()*1000), sequence,
+                                             urllib.quote(unicode(printer_name).encode('utf-8'), ''),
+                                             extension)
+
+    @staticmethod
+    def printer_name(file_name):
+        quoted = os.path.splitext(file_name)[0].split('-', 2)[2]
+        return urllib.unquote(quoted).decode('utf-8')
+
+    def spool(self, printer, job):
+        """
+        Renders the job for the printer to a file in the spool,
+        and returns its path.
+        """
+        extension = 'escpos' if printer.backend == 'escpos' else 'pdf'
+        name = self.file_name(printer.name, extension)
+
+        fd, temp = tempfile.mkstemp(prefix=self.TEMP_PREFIX, dir=self.directory)
+        try:
+            if printer.backend == 'escpos':
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(printer.render(job))
+            else:
+                os.close(fd)
+                job.handler(self.pdf_printer(printer, temp))
+            path = os.path.join(self.directory, name)
+            with self.__lock:
+                self.__jobs[name] = job
+            os.rename(temp, path)
+        except:
+            with self.__lock:
+                self.__jobs.pop(name, None)
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+
+        logger.debug('Spooled %s', path)
+        self.__wakeup.set()
+        return path
+
+    @staticmethod
+    def pdf_printer(printer, path):
+        """
+        Returns a QPrinter writing to the PDF file `path`, with the page
+        setup of the printer.
+        """
+        source = printer.qprinter
+        unit = QtGui.QPrinter.Millimeter
+
+        qp = QtGui.QPrinter(QtGui.QPrinter.HighResolution)
+        qp.setOutputFormat(QtGui.QPrinter.PdfFormat)
+        qp.setOutputFileName(path)
+        qp.setOrientation(source.orientation())
+        qp.setPaperSize(source.paperSize(unit), unit)
+        qp.setFullPage(source.fullPage())
+        qp.setPageMargins(*(list(source.getPageMargins(unit))+[unit]))
+        return qp
+
+    def pending(self):
+        """
+        Returns the names of the files waiting to be sent, oldest first.
+        """
+        return sorted(name for name in os.listdir(self.directory)
+                        if not name.startswith(self.TEMP_PREFIX) and \
+                            os.path.isfile(os.path.join(self.directory, name)))
+
+    def done(self):
+        """
+        Returns the names of the files already sent, oldest first.
+        """
+        return sorted(os.listdir(self.done_directory))
+
+    def failed(self):
+        """
+        Returns the names of the files which could not be sent, oldest first.
+        """
+        return sorted(os.listdir(self.failed_directory))
+
+    def reprint(self, name, failed=False):
+        """
+        Sends the file `name`, which was already sent, again.
+        With `failed`, it is one of the files which could not be sent.
+        """
+        source = os.path.join(self.failed_directory if failed else self.done_directory, name)
+        extension = os.path.splitext(name)[1][1:]
+        target = os.path.join(self.directory, self.file_name(self.printer_name(name), extension))
+        shutil.copyfile(source, target)
+        self.__wakeup.set()
+        return target
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__run, name='PrintSpooler')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        self.__stopped = True
+        self.__wakeup.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            self.__thread = None
+
+    def __run(self):
+        while not self.__stopped:
+            self.__wakeup.clear()
+            failed = self.drain()
+            # Try again later if some could not be sent
+            self.__wakeup.wait(self.retry if failed else None)
+
+    def drain(self):
+        """
+        Sends the pending files, in order for every printer.
+        Returns whether some of them could not be sent.
+        """
+        failed_printers = set()
+        for name in self.pending():
+            if self.__stopped:
+                break
+
+            printer_name = self.printer_name(name)
+            if printer_name in failed_printers:
+                # Keep the order of the jobs of that printer
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                printer = self.load_printer(printer_name)
+            except InvalidPrinterName as e:
+                logger.error('Printer %s does not exist anymore, moving %s to %s',
+                             printer_name, name, self.failed_directory)
+                self.__give_up(name, printer_name, e)
+                continue
+
+            try:
+                self.send(printer, path)
+            except Exception as e:
+                failures = self.__failures.get(name, 0) + 1
+                if failures >= self.attempts:
+                    logger.exception('Could not send %s to %s after %d attempts, moving it to %s',
+                                     name, printer_name, failures, self.failed_directory)
+                    self.__give_up(name, printer_name, e)
+                else:
+                    logger.exception('Could not send %s to %s, will retry', name, printer_name)
+                    self.__failures[name] = failures
+                    failed_printers.add(printer_name)
+                continue
+
+            self.__failures.pop(name, None)
+            os.rename(path, os.path.join(self.done_directory, name))
+            logger.debug('Sent %s to %s', name, printer_name)
+            self.__report(name, printer_name)
+
+        self.prune()
+        return len(failed_printers) > 0
+
+    def __give_up(self, name, printer_name, error):
+        self.__failures.pop(name, None)
+        os.rename(os.path.join(self.directory, name), os.path.join(self.failed_directory, name))
+        self.__report(name, printer_name, error)
+
+    def __report(self, name, printer_name, error=None):
+        with self.__lock:
+            job = self.__jobs.pop(name, None)
+        # Files left from before the start, or reprinted, have no job
+        if job is not None and self.notify is not None:
+            self.notify(printer_name, job, error)
+
+    def prune(self):
+        done = self.done()
+        for name in done[:max(0, len(done)-self.keep)]:
+            try:
+                os.remove(os.path.join(self.done_directory, name))
+            except OSError:
+                pass
+
+    @staticmethod
+    def send(printer, path):
+        """
+        Sends the spooled file at `path` to the printer.
+        """
+        if printer.backend == 'escpos':
+            with open(path, 'rb') as f:
+                escpos.send(printer.device, f.read())
+            return
+
+        qp = printer.qprinter
+        if qp.outputFormat() == QtGui.QPrinter.PdfFormat and qp.outputFileName():
+            # Prints to a file
+            shutil.copyfile(path, qp.outputFileName())
+        elif sys.platform == 'win32':
+            Spooler.send_windows(qp.printerName(), path)
+        else:
+            command = ['lp', '-n', str(max(1, qp.copyCount()))]
+            if qp.printerName():
+                command += ['-d', qp.printerName()]
+            subprocess.check_call(command + Spooler.lp_options(qp) + [path])
+
+    @staticmethod
+    def lp_options(qp):
+        """
+        Returns the lp options for the settings of the QPrinter `qp` which
+        are not in the spooled PDF file: the pages to print, duplex, colour
+        and collation.
+        """
+        options = []
+        if qp.printRange() == QtGui.QPrinter.PageRange and qp.fromPage() > 0:
+            options += ['-P', '{}-{}'.format(qp.fromPage(), qp.toPage() or qp.fromPage())]
+
+        duplex = qp.duplex()
+        if duplex == QtGui.QPrinter.DuplexAuto:
+            duplex = QtGui.QPrinter.DuplexLongSide \
+                        if qp.orientation() == QtGui.QPrinter.Portrait \
+                        else QtGui.QPrinter.DuplexShortSide
+        sides = {QtGui.QPrinter.DuplexNone: 'one-sided',
+                 QtGui.QPrinter.DuplexLongSide: 'two-sided-long-edge',
+                 QtGui.QPrinter.DuplexShortSide: 'two-sided-short-edge'}.get(duplex)
+        if sides is not None:
+            options += ['-o', 'sides='+sides]
+
+        if qp.colorMode() == QtGui.QPrinter.GrayScale:
+            options += ['-o', 'print-color-mode=monochrome']
+        else:
+            options += ['-o', 'print-color-mode=color']
+
+        if qp.copyCount() > 1:
+            options += ['-o', 'collate={}'.format('true' if qp.collateCopies() else 'false')]
+        return options
+
+    @staticmethod
+    def send_windows(printer_name, path):
+        """
+        Prints the file with the application registered for its type, on the
+        printer `printer_name`. Without pywin32, only the default printer can
+        be printed to: files for the others fail rather than go to it.
+        The application prints with the settings of the printer in Windows:
+        the copies, pages, duplex and colour chosen in Coinbox are not used.
+        """
+        try:
+            import win32api
+        except ImportError:
+            win32api = None
+
+        if win32api is not None:
+            if printer_name:
+                win32api.ShellExecute(0, 'printto', path, '"{}"'.format(printer_name), '.', 0)
+            else:
+                win32api.ShellExecute(0, 'print', path, None, '.', 0)
+        elif not printer_name or \
+                printer_name == QtGui.QPrinterInfo.defaultPrinter().printerName():
+            os.startfile(path, 'print')
+        else:
+            raise IOError('pywin32 is needed to print to {}, which is not the default printer'.format(printer_name))
@@ -0,0 +1,150 @@
+"""
+Image processing steps shared by StoredFile.image and the bulk image importer.
+This module only depends on PIL, so that it can be used in worker processes
+without setting up the database or the interface.
+"""
+import os
+import logging
+from cStringIO import StringIO
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff')
+
+def open_image(path):
+    from PIL import Image
+
+    try:
+        return Image.open(path)
+    except IOError:
+        # PIL cannot identify the image
+        # Or the image is not readable
+        raise ValueError("Invalid image file")
+
+def fit_image(im, path, size=None, format=None):
+    """
+    Resizes the PIL image `im` opened from `path` to fit in `size`, centered
+    on a white background, for it to be saved in `format`.
+    Returns (final_im, format, PIL_format).
+    """
+    from PIL import Image
+
+    basename = os.path.basename(path)
+    filename, ext = os.path.splitext(basename)
+    original_size = im.size
+
+    if format is None:
+        # If no specific format is specified just use whatever is there
+        # And keep the same extension
+        PIL_format = im.format
+        format = ext[1:] if ext.startswith(".") else ext
+    else:
+        # Let PIL guess it from the format (extension)
+        PIL_format = None
+
+    if size is None:
+        # Do not resize
+        # Note: do not return because format may be different (transparency, background, etc.)
+        size = original_size
+    else:
+        size = tuple(size)
+
+    logger.debug("Resizing from %s to %s", original_size, size)
+    logger.debug("Converting to %s/%s from %s/%s", format, PIL_format, ext, im.format)
+
+    # If some processing is necessary, do it now.
+    final_im = Image.new("RGB", size, "white")
+    # Resize the image
+    im.thumbnail(size, Image.ANTIALIAS)
+
+    # Center it in the image with the desired size
+    actual_size = im.size
+    paste_pos = tuple((size[i]-actual_size[i])/2 for i in (0, 1))
+    final_im.paste(im, paste_pos)
+
+    return final_im, format, PIL_format
+
+def encode_image(im, format, PIL_format=None):
+    """
+    Encodes the PIL image `im` in memory and returns the encoded string.
+    """
+    from PIL import Image
+
+    f = StringIO()
+    # We cannot use the below because of cStringIO, it works for StringIO
+    #f.name = path
+    # So we try to guess it, just like PIL does it
+    if PIL_format is None:
+        try:
+            PIL_format = Image.EXTENSION["."+format]
+        except KeyError:
+            Image.init()
+            try:
+                PIL_format = Image.EXTENSION["."+format]
+            except KeyError:
+                # let it fail from within PIL's save
+                pass
+        logger.debug("Final PIL_format: %s", PIL_format)
+
+    try:
+        im.save(f, PIL_format)
+    except KeyError:
+        # PIL cannot identify the image
+        raise ValueError("Invalid output image type")
+
+    content = f.getvalue()
+    f.close()
+    return content
+
+def scaled_images(im, sizes):
+    """
+    Yields (size, scaled_im) for each of `sizes` smaller than the PIL image `im`,
+    where scaled_im fits in a square of that size.
+    """
+    from PIL import Image
+
+    for size in sorted(set(sizes)):
+        if size >= max(im.size):
+            break
+
+        scaled_im = im.copy()
+        scaled_im.thumbnail((size, size), Image.ANTIALIAS)
+        yield size, scaled_im
+
+def process_image(path, size=None, format=None, renditions=()):
+    """
+    Runs the whole StoredFile.image pipeline on `path`, in memory.
+    Returns (name, content, [(rendition_size, content), ...]).
+    """
+    im = open_image(path)
+
+    if size is None and format is None:
+        # No need to process anything
+        name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+        final_im, PIL_format = im, im.format
+        format = os.path.splitext(name)[1][1:]
+    else:
+        final_im, format, PIL_format = fit_image(im, path, size, format)
+        name = os.path.splitext(os.path.basename(path))[0]+"."+format
+        content = encode_image(final_im, format, PIL_format)
+
+    return (name, content,
+            [(s, encode_image(scaled_im, format, PIL_format))
+                for s, scaled_im in scaled_images(final_im, renditions)])
+
+def find_images(sources):
+    """
+    Yields the paths of the image files in `sources`,
+    which are paths to files or directories to walk through.
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for dirpath, dirnames, filenames in os.walk(source):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(dirpath, filename)
+        else:
+            yield source
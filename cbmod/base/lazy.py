@@ -0,0 +1,57 @@
+"""
+Packages whose attributes are only imported from their submodules when they
+are first used, so that importing one of them does not load all the others.
+"""
+import sys
+import types
+import importlib
+
+class LazyModule(types.ModuleType):
+    """
+    Replaces a package in sys.modules. It has everything the package has, and
+    `attributes`, a dict of attribute name -> module to import it from, which
+    may be relative to the package.
+    """
+
+    def __init__(self, module, attributes):
+        super(LazyModule, self).__init__(module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+
+        # Hold on to the original module: its globals are cleared when
+        # it gets garbage collected, and its functions still use them
+        self.__dict__['_LazyModule__module'] = module
+        self.__dict__['_LazyModule__attributes'] = attributes
+        self.__dict__['__all__'] = sorted(attributes)
+
+    def __getattr__(self, name):
+        # Only called when the attribute was not found the usual way
+        try:
+            module_name = self.__attributes[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '{}'".format(name))
+
+        module = importlib.import_module(module_name, self.__name__)
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self.__attributes))
+
+def lazy_package(name, attributes):
+    """
+    Makes the attributes of the package `name` lazy. Call it at the end of
+    the package's __init__ with `__name__`:
+
+        lazy_package(__name__, {'MainWindow': '.window'})
+    """
+    module = sys.modules[name]
+    if isinstance(module, LazyModule):
+        return module
+    lazy = sys.modules[name] = LazyModule(module, attributes)
+
+    # In case the parent package already refers to the original module
+    parent, _, child = name.rpartition('.')
+    if parent and parent in sys.modules:
+        setattr(sys.modules[parent], child, lazy)
+    return lazy
@@ -1,21 +1,68 @@
+import sys
+
 from pydispatch import dispatcher
 
 import cbpos
+logger = cbpos.get_logger(__name__)
+
 from cbpos.modules import BaseModuleLoader
 
+from cbmod.base import profiling
+
+# The printing signals are handled by the printing manager,
+# which is only imported and created once one of them is sent
+
+def register_printer_function(function):
+    from cbmod.base.controllers import printing
+    printing.manager.register_function(function)
+
+def handle_print_job(job, function):
+    from cbmod.base.controllers import printing
+    printing.manager.handle(job, function)
+
+def handle_print_jobs(jobs, function):
+    from cbmod.base.controllers import printing
+    printing.manager.handle_many(jobs, function)
+
+def shutdown_printing():
+    printing = sys.modules.get('cbmod.base.controllers.printing')
+    if printing is not None:
+        printing.manager.shutdown()
+
 class ModuleLoader(BaseModuleLoader):
     def load_models(self):
-        from cbmod.base.models import StoredFile
-        return [StoredFile]
+        from cbmod.base.models import StoredFile, StoredBlob, StoredBlobChunk
+        return [StoredBlob, StoredBlobChunk, StoredFile]
 
     def init(self):
-        from cbmod.base.controllers import printing
+        profiling.start_from_config()
         
-        printing.manager = printing.PrinterManager()
+        with profiling.phase('ModuleLoader.init base', 'module'):
+            from cbmod.base.models import migrations
+            try:
+                migrations.upgrade()
+            except Exception:
+                logger.exception('Could not upgrade the database')
+                return False
+            
+            from cbmod.base import cache
+            from cbmod.base.views import icons
+            
+            cache.manager = cache.FileCache.from_config()
+            icons.manager = icons.IconCache.from_config()
+            
+            # The printing manager is only created when it is first used,
+            # unless the jobs left in the spool have to be sent
+            if cbpos.config['printing', 'spool']:
+                from cbmod.base.controllers import printing
+                printing.manager.start_spooler()
         
+        # Let the queued print jobs finish before terminating
+        dispatcher.connect(shutdown_printing, signal='exit', sender=dispatcher.Any)
         dispatcher.connect(cbpos.loader.terminate, signal='exit', sender=dispatcher.Any)
-        dispatcher.connect(printing.manager.register_function, signal='printing-register-function', sender=dispatcher.Any)
-        dispatcher.connect(printing.manager.handle, signal='printing-handle', sender=dispatcher.Any)
+        dispatcher.connect(register_printer_function, signal='printing-register-function', sender=dispatcher.Any)
+        dispatcher.connect(handle_print_job, signal='printing-handle', sender=dispatcher.Any)
+        dispatcher.connect(handle_print_jobs, signal='printing-handle-batch', sender=dispatcher.Any)
         
         return True
 
@@ -13,7 +13,34 @@ class ModuleMetadata(BaseModuleMetadata):
                   }
          ),
         ('printing', {
-                      'force_preview': False
+                      'force_preview': False,
+                      'async': False,
+                      'spool': False,
+                      'spool_directory': '',
+                      'spool_keep': 100,
+                      'spool_retry': 10,
+                      'spool_attempts': 5
                       }
          ),
+        ('catalog', {
+                     'search_delay': 200,
+                     'scanner_delay': 50,
+                     'scanner_interval': 30
+                     }
+         ),
+        ('images', {
+                    'tempfile_min_pixels': 0
+                    }
+         ),
+        ('cache', {
+                   'directory': '',
+                   'max_size': 64*2**20,
+                   'icons_max_size': 16*2**20
+                   }
+         ),
+        ('profiling', {
+                       'enabled': False,
+                       'output': ''
+                       }
+         ),
     )
@@ -1,2 +1,3 @@
 from .common import Item
+from .storedblob import StoredBlob, StoredBlobChunk
 from .storedfile import StoredFile
\ No newline at end of file
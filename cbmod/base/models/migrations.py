@@ -0,0 +1,128 @@
+"""
+Upgrades the tables of existing databases to the current models.
+New tables are created with the others, but the columns added to existing
+tables, and the data that has to move to them, are handled here.
+"""
+import hashlib
+
+import cbpos
+
+logger = cbpos.get_logger(__name__)
+
+from cbmod.base.models.storedblob import StoredBlob
+from cbmod.base.models.storedfile import StoredFile
+
+from sqlalchemy import exc, select, Table, MetaData, Column, Integer, String, LargeBinary, \
+                        ForeignKeyConstraint
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import AddConstraint
+
+# Columns of storedfiles added since the contents were stored in it
+STOREDFILE_COLUMNS = ('size', 'hash', 'original_id', 'rendition_size')
+
+# Column of storedfiles the contents were stored in
+OLD_STOREDFILE_COLUMNS = ('content',)
+
+def upgrade():
+    """
+    Upgrades the database of the current session, if it needs to be.
+    """
+    session = cbpos.database.session()
+    try:
+        upgrade_storedfiles(session.connection())
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+def upgrade_storedfiles(connection):
+    """
+    Moves the contents stored in the storedfiles table to the blobs,
+    filling in the hash and size of every file, and only then drops the
+    columns they were stored in.
+    """
+    inspector = Inspector.from_engine(connection)
+    tables = inspector.get_table_names()
+    if 'storedfiles' not in tables:
+        # Created as it is now
+        return
+
+    columns = set(c['name'] for c in inspector.get_columns('storedfiles'))
+    added = [name for name in STOREDFILE_COLUMNS if name not in columns]
+    old = [name for name in OLD_STOREDFILE_COLUMNS if name in columns]
+    if not added and not old:
+        return
+
+    logger.info('Upgrading the storedfiles table')
+    sqlite = connection.dialect.name == 'sqlite'
+    table = StoredFile.__table__
+
+    for name in added:
+        column = table.c[name]
+        definition = '{} {}'.format(name, column.type.compile(dialect=connection.dialect))
+        if sqlite:
+            # SQLite cannot add the constraints afterwards
+            for fk in column.foreign_keys:
+                definition += ' REFERENCES {}({})'.format(fk.column.table.name, fk.column.name)
+        connection.execute('ALTER TABLE storedfiles ADD COLUMN {}'.format(definition))
+
+    if 'content' in columns:
+        move_contents(connection)
+
+    for name in old:
+        drop_column(connection, name)
+
+    if not sqlite:
+        for constraint in table.constraints:
+            if isinstance(constraint, ForeignKeyConstraint) and \
+                    any(c.name in added for c in constraint.columns):
+                connection.execute(AddConstraint(constraint))
+
+    for index in table.indexes:
+        if any(c.name in added for c in index.columns):
+            index.create(connection)
+
+def drop_column(connection, name):
+    """
+    Drops the column `name` of storedfiles. SQLite before 3.35 cannot drop
+    columns, the column is emptied instead: it is not mapped anymore.
+    """
+    if connection.dialect.name == 'sqlite':
+        try:
+            connection.execute('ALTER TABLE storedfiles DROP COLUMN {}'.format(name))
+        except exc.OperationalError:
+            logger.info('Could not drop storedfiles.%s, emptying it', name)
+            connection.execute('UPDATE storedfiles SET {} = NULL'.format(name))
+    else:
+        connection.execute('ALTER TABLE storedfiles DROP COLUMN {}'.format(name))
+
+def move_contents(connection):
+    """
+    Stores the content of the files which have no hash yet in the blobs,
+    one file at a time so that they are never all in memory.
+    """
+    old = Table('storedfiles', MetaData(),
+                Column('id', Integer, primary_key=True),
+                Column('hash', String(64)),
+                Column('size', Integer),
+                Column('content', LargeBinary))
+
+    def file_chunks(file_id):
+        content = connection.execute(select([old.c.content]) \
+                                        .where(old.c.id == file_id)).scalar() or ''
+        for i in xrange(0, len(content), StoredBlob.CHUNK_SIZE):
+            yield content[i:i+StoredBlob.CHUNK_SIZE]
+
+    file_ids = [row.id for row in connection.execute(select([old.c.id]).where(old.c.hash == None))]
+    for file_id in file_ids:
+        digest = hashlib.sha256()
+        size = 0
+        for data in file_chunks(file_id):
+            digest.update(data)
+            size += len(data)
+        hash = digest.hexdigest()
+
+        StoredBlob.acquire(connection, hash, size, lambda: file_chunks(file_id))
+        connection.execute(old.update().where(old.c.id == file_id).values(hash=hash, size=size))
+
+    logger.info('Moved the content of %d stored files to blobs', len(file_ids))
@@ -0,0 +1,112 @@
+import cbpos
+
+logger = cbpos.get_logger(__name__)
+
+from sqlalchemy import select, Column, Integer, String, Boolean, LargeBinary, ForeignKey
+from sqlalchemy.orm import deferred
+
+class StoredBlobChunk(cbpos.database.Base):
+    __tablename__ = 'storedblob_chunks'
+
+    blob_id = Column(Integer, ForeignKey('storedblobs.id'), primary_key=True)
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    data = Column(LargeBinary(2**32-1))
+
+class StoredBlob(cbpos.database.Base):
+    """
+    The content of stored files, stored once per distinct content and
+    shared by all the StoredFile's with the same hash.
+    """
+    __tablename__ = 'storedblobs'
+
+    # Blobs bigger than this are stored in chunks of this size
+    CHUNK_SIZE = 2**20
+
+    id = Column(Integer, primary_key=True)
+    hash = Column(String(64), nullable=False, unique=True, index=True)
+    size = Column(Integer, default=0)
+    refcount = Column(Integer, default=0)
+    chunked = Column(Boolean, default=False)
+    # Only used when the blob is not chunked, see `iter_chunks`
+    content = deferred(Column("content", LargeBinary(2**32-1)))
+
+    def iter_chunks(self, chunk_size=None):
+        """
+        Iterate over the content without loading all of it in memory.
+        """
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+
+        if self.chunked:
+            session = cbpos.database.session()
+            query = session.query(StoredBlobChunk.data) \
+                        .filter(StoredBlobChunk.blob_id == self.id) \
+                        .order_by(StoredBlobChunk.seq)
+            for (data,) in query.yield_per(1):
+                yield data
+        elif self.content:
+            content = self.content
+            for i in xrange(0, len(content), chunk_size):
+                yield content[i:i+chunk_size]
+
+    @classmethod
+    def acquire(cls, connection, hash, size, chunks, chunked=None):
+        """
+        Adds a reference to the blob with this `hash`.
+        If it does not exist yet, it is created from the iterator returned
+        by calling `chunks`, which is never called otherwise.
+        """
+        table = cls.__table__
+
+        row = connection.execute(select([table.c.id]).where(table.c.hash == hash)).first()
+        if row is not None:
+            connection.execute(table.update() \
+                                    .where(table.c.id == row.id) \
+                                    .values(refcount=table.c.refcount + 1))
+            return row.id
+
+        if chunked is None:
+            chunked = size > cls.CHUNK_SIZE
+
+        if not chunked:
+            result = connection.execute(table.insert(), hash=hash, size=size,
+                                        refcount=1, chunked=False,
+                                        content=''.join(chunks()))
+            return result.inserted_primary_key[0]
+
+        result = connection.execute(table.insert(), hash=hash, size=size,
+                                    refcount=1, chunked=True, content=None)
+        blob_id = result.inserted_primary_key[0]
+
+        chunk_table = StoredBlobChunk.__table__
+        for seq, data in enumerate(chunks()):
+            connection.execute(chunk_table.insert(), blob_id=blob_id, seq=seq, data=data)
+
+        return blob_id
+
+    @classmethod
+    def release(cls, connection, hash):
+        """
+        Removes a reference to the blob with this `hash`,
+        deleting it once it is not referenced anymore.
+        """
+        table = cls.__table__
+
+        connection.execute(table.update() \
+                                .where(table.c.hash == hash) \
+                                .values(refcount=table.c.refcount - 1))
+
+        row = connection.execute(select([table.c.id, table.c.refcount]) \
+                                    .where(table.c.hash == hash)).first()
+        if row is not None and row.refcount <= 0:
+            logger.debug("Deleting unreferenced blob %s", hash)
+            chunk_table = StoredBlobChunk.__table__
+            connection.execute(chunk_table.delete().where(chunk_table.c.blob_id == row.id))
+            connection.execute(table.delete().where(table.c.id == row.id))
+
+            from cbmod.base import cache
+            if cache.manager is not None:
+                cache.manager.invalidate(hash)
+
+    def __repr__(self):
+        return "<StoredBlob %s>" % (self.hash,)
@@ -1,16 +1,19 @@
 import os
+import weakref
+import hashlib
 import tempfile
-from cStringIO import StringIO
 
 import cbpos
 
 logger = cbpos.get_logger(__name__)
 
+from cbmod.base import imaging
 from cbmod.base.models import Item
+from cbmod.base.models.storedblob import StoredBlob
 
-from sqlalchemy import func, Table, Column, Integer, String, Float, Boolean, LargeBinary, Enum, MetaData, ForeignKey
-from sqlalchemy.orm import relationship, backref, deferred
-from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method, Comparator
+from sqlalchemy import event, Column, Integer, String, ForeignKey
+from sqlalchemy.orm import Session, relationship, backref, attributes, object_session
+from sqlalchemy.ext.hybrid import hybrid_property
 
 class StoredFile(cbpos.database.Base, Item):
     __tablename__ = 'storedfiles'
@@ -18,30 +21,169 @@ class StoredFile(cbpos.database.Base, Item):
     id = Column(Integer, primary_key=True)
     filename = Column(String(255), default='')
     filetype = Column(String(5), default='')
-    content = deferred(Column("content", LargeBinary(2**32-1)))
+    size = Column(Integer, default=0)
+    # SHA-256 of the content, which is stored once per hash in StoredBlob
+    hash = Column(String(64), ForeignKey('storedblobs.hash'), index=True)
+    blob = relationship(StoredBlob, viewonly=True)
+    # Pre-scaled copies of images, see `image` and `rendition`
+    original_id = Column(Integer, ForeignKey('storedfiles.id'), nullable=True)
+    rendition_size = Column(Integer, nullable=True)
+    renditions = relationship('StoredFile',
+                              cascade='all, delete-orphan',
+                              order_by='StoredFile.rendition_size',
+                              backref=backref('original', remote_side=[id]))
 
-    def __init__(self, path, content_file=None):
+    # Maximum width/height of the renditions generated for images by default
+    RENDITION_SIZES = (48, 128, 256)
+
+    # Content to be stored on the next flush, if it is not a duplicate
+    __source = None
+    __chunked = None
+
+    def __init__(self, path, content_file=None, chunked=None):
         basename = os.path.basename(path)
         filename, filetype = os.path.splitext(basename)
         # TODO: guess file type from mimetypes package, not extension
         if content_file is None:
-            try:
-                with open(path, 'rb') as f:
-                    content = f.read()
-            except IOError as e:
+            if not os.access(path, os.R_OK):
                 logger.error("Could not read file")
-                logger.error(e)
-                content = u""
+                logger.error(path)
+                content = ""
+            else:
+                # Do not read the whole file now, it is streamed when needed
+                content = None
         elif isinstance(content_file, basestring):
             content = content_file
         else:
+            # The file object might be closed by the time we flush
+            content = tempfile.SpooledTemporaryFile(max_size=StoredBlob.CHUNK_SIZE)
             content_file.seek(0)
-            content = content_file.read()
+            for data in iter(lambda: content_file.read(StoredBlob.CHUNK_SIZE), ''):
+                content.write(data)
+        
+        super(StoredFile, self).__init__(filetype=filetype, filename=filename)
+        self.__set_source(path, content, chunked)
+
+    def __set_source(self, path, content, chunked=None):
+        """
+        Sets the content to be stored and computes its hash,
+        reading it one chunk at a time.
+        `content` is either a string, a file object or None to read `path`.
+        """
+        self.__source = (path, content)
+        self.__chunked = chunked
+        
+        digest = hashlib.sha256()
+        size = 0
+        for data in self.__iter_source(StoredBlob.CHUNK_SIZE):
+            digest.update(data)
+            size += len(data)
+        
+        self.hash = digest.hexdigest()
+        self.size = size
+
+    def __iter_source(self, chunk_size):
+        path, content = self.__source
+        if content is None:
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(chunk_size), ''):
+                    yield data
+        elif isinstance(content, basestring):
+            for i in xrange(0, len(content), chunk_size):
+                yield content[i:i+chunk_size]
+        else:
+            content.seek(0)
+            for data in iter(lambda: content.read(chunk_size), ''):
+                yield data
+
+    def store_content(self, connection):
+        """
+        References the blob for the pending content, storing it only if
+        no blob with the same hash exists. See `_before_insert`.
+        """
+        if self.__source is None:
+            return
+        
+        StoredBlob.acquire(connection, self.hash, self.size,
+                           lambda: self.__iter_source(StoredBlob.CHUNK_SIZE),
+                           self.__chunked)
         
-        super(StoredFile, self).__init__(filetype=filetype, content=content, filename=filename)
+        # The blob is only there for good once the transaction commits
+        session = object_session(self)
+        if session is not None:
+            _stored.setdefault(session, set()).add(self)
+        else:
+            self.__source = None
+
+    def _content_committed(self):
+        """
+        The blob the pending content was stored in is committed,
+        the content is read from it from now on.
+        """
+        self.__source = None
+        self.__chunked = None
+
+    @property
+    def content(self):
+        """
+        The whole content of the file.
+        Prefer `open` or `iter_chunks` for large files.
+        """
+        return ''.join(self.iter_chunks())
+
+    @content.setter
+    def content(self, content):
+        if content is None:
+            content = ""
+        self.__set_source(self.filename+self.filetype, content)
+
+    def iter_chunks(self, chunk_size=None):
+        """
+        Iterate over the content of the file without loading all of it in memory.
+        """
+        if chunk_size is None:
+            chunk_size = StoredBlob.CHUNK_SIZE
+        
+        if self.__source is not None:
+            # Not stored yet
+            return self.__iter_source(chunk_size)
+        elif self.blob is not None:
+            return self.blob.iter_chunks(chunk_size)
+        else:
+            return iter([])
+
+    def open(self, mode='rb'):
+        """
+        Returns a file-like object to read the content of the file ('rb'),
+        or to replace it ('wb'), in bounded memory.
+        """
+        if mode == 'rb':
+            return StoredFileReader(self.iter_chunks())
+        elif mode == 'wb':
+            return StoredFileWriter(self)
+        else:
+            raise ValueError("Invalid mode {}".format(mode))
+
+    @classmethod
+    def by_hash(cls, hash):
+        """
+        Returns a query of the stored files with this content hash.
+        """
+        session = cbpos.database.session()
+        return session.query(cls).filter(cls.hash == hash)
+
+    def same_content(self, other):
+        return self.hash is not None and self.hash == other.hash
 
     @classmethod
-    def image(cls, path, size=None, format=None):
+    def image(cls, path, size=None, format=None, renditions=None):
+        """
+        Creates a StoredFile for the image at `path`, resized to `size`
+        and converted to `format` if given, along with pre-scaled renditions
+        of it for each of the `renditions` sizes (RENDITION_SIZES by default).
+        """
+        if renditions is None:
+            renditions = cls.RENDITION_SIZES
         
         try:
             from PIL import Image
@@ -50,104 +192,115 @@ class StoredFile(cbpos.database.Base, Item):
             return cls(path)
         
         # First, open the path
-        try:
-            im = Image.open(path)
-        except IOError:
-            # PIL cannot identify the image
-            # Or the image is not readable
-            raise ValueError("Invalid image file")
-        
-        # Get some info about it
-        basename = os.path.basename(path)
-        filename, ext = os.path.splitext(basename)
-        original_size = im.size
+        im = imaging.open_image(path)
         
         if size is None and format is None:
             # No need to process anything
-            return cls(path)
-        
-        if format is None:
-            # If no specific format is specified just use whatever is there
-            # And keep the same extension
-            PIL_format = im.format
-            format = ext[1:] if ext.startswith(".") else ext
-        else:
-            # Let PIL guess it from the format (extension)
-            PIL_format = None
-        
-        if size is None:
-            # Do not resize
-            # Note: do not return because format may be different (transparency, background, etc.)
-            size = original_size
-        else:
-            size = tuple(size)
+            image = cls(path)
+            image.make_renditions(im, renditions, im.format)
+            return image
         
-        logger.debug("Resizing from %s to %s", original_size, size)
-        logger.debug("Converting to %s/%s from %s/%s", format, PIL_format, ext, im.format)
-        
-        # If some processing is necessary, do it now.
-        final_im = Image.new("RGB", size, "white")
-        # Resize the image
-        im.thumbnail(size, Image.ANTIALIAS)
-        
-        # Center it in the image with the desired size
-        actual_size = im.size
-        paste_pos = tuple((size[i]-actual_size[i])/2 for i in (0, 1))
-        final_im.paste(im, paste_pos)
+        final_im, format, PIL_format = imaging.fit_image(im, path, size, format)
         
+        filename = os.path.splitext(os.path.basename(path))[0]
+        image = cls.__from_image(final_im, filename, format, PIL_format)
+        image.make_renditions(final_im, renditions, PIL_format, format)
+        return image
+
+    @classmethod
+    def __from_image(cls, final_im, filename, format, PIL_format):
+        """
+        Encodes the PIL image `final_im` and returns a new instance for it.
+        The image is encoded in memory, unless it has more pixels than the
+        images.tempfile_min_pixels setting, in which case it goes through
+        a temporary file.
+        """
         try:
-            # Create a temporary file
-            fd, temp = tempfile.mkstemp(suffix="."+format)
-        except IOError as e:
-            logger.exception("Could not create temporary file. Manipulating in memory")
-            
-            f = StringIO()
-            # We cannot use the below because of cStringIO, it works for StringIO
-            #f.name = path
-            # So we try to guess it, just like PIL does it
-            if PIL_format is None:
-                try:
-                    PIL_format = Image.EXTENSION["."+format]
-                except KeyError:
-                    Image.init()
-                    try:
-                        PIL_format = Image.EXTENSION["."+format]
-                    except KeyError:
-                        # let it fail from within PIL's save
-                        pass
-                logger.debug("Final PIL_format: %s", PIL_format)
-            
-            try:
-                final_im.save(f, PIL_format)
-            except KeyError:
-                # PIL cannot identify the image
-                raise ValueError("Invalid output image type")
-            image = cls(filename+"."+format, f)
-            
-            f.close()
-        else:
-            logger.debug("Image will be saved temporarily to: " + temp)
-            
-            try:
-                final_im.save(temp, PIL_format)
-            except KeyError:
-                # PIL cannot identify the image
-                raise ValueError("Invalid output image type")
-            
-            with open(temp, 'rb') as f:
-                # Create the StoredFile instance
-                image = cls(filename+"."+format, f)
-            
-            # tempfile.mkstemp does not delete the file once created
+            tempfile_min_pixels = int(cbpos.config['images', 'tempfile_min_pixels'])
+        except (ValueError, TypeError):
+            tempfile_min_pixels = 0
+        
+        width, height = final_im.size
+        if tempfile_min_pixels > 0 and width * height > tempfile_min_pixels:
             try:
-                os.remove(temp)
+                # Create a temporary file
+                fd, temp = tempfile.mkstemp(suffix="."+format)
             except (OSError, IOError) as e:
-                # Could not delete the temp file
-                # Maybe because it's on Windows, or it's already gone
-                pass
-    
+                logger.exception("Could not create temporary file. Manipulating in memory")
+            else:
+                os.close(fd)
+                logger.debug("Image will be saved temporarily to: " + temp)
+                
+                try:
+                    final_im.save(temp, PIL_format)
+                except KeyError:
+                    # PIL cannot identify the image
+                    raise ValueError("Invalid output image type")
+                
+                with open(temp, 'rb') as f:
+                    # Create the StoredFile instance
+                    image = cls(filename+"."+format, f)
+                
+                # tempfile.mkstemp does not delete the file once created
+                try:
+                    os.remove(temp)
+                except (OSError, IOError) as e:
+                    # Could not delete the temp file
+                    # Maybe because it's on Windows, or it's already gone
+                    pass
+                
+                return image
+        
+        # The StoredFile keeps the encoded string as is
+        return cls(filename+"."+format, imaging.encode_image(final_im, format, PIL_format))
+
+    @classmethod
+    def from_encoded(cls, name, content, renditions=()):
+        """
+        Creates a StoredFile for already encoded image `content`,
+        along with its encoded `renditions`, a list of (size, content),
+        as returned by `cbmod.base.imaging.process_image`.
+        """
+        image = cls(name, content)
+        filename, filetype = os.path.splitext(name)
+        for size, rendition_content in renditions:
+            rendition = cls("{}-{}{}".format(filename, size, filetype), rendition_content)
+            rendition.rendition_size = size
+            image.renditions.append(rendition)
         return image
 
+    def make_renditions(self, im, sizes, PIL_format=None, format=None):
+        """
+        Adds a rendition of the PIL image `im` that fits in each of `sizes`.
+        Renditions are never bigger than the image itself.
+        """
+        if format is None:
+            format = self.filetype[1:] if self.filetype.startswith(".") else self.filetype
+        
+        for size, rendition_im in imaging.scaled_images(im, sizes):
+            rendition = self.__from_image(rendition_im,
+                                          "{}-{}".format(self.filename, size),
+                                          format, PIL_format)
+            rendition.rendition_size = size
+            self.renditions.append(rendition)
+
+    def rendition(self, size):
+        """
+        Returns the smallest rendition that is at least `size` pixels wide
+        and high, or the original image if there is none.
+        `size` is either a number or an object with width() and height().
+        """
+        try:
+            size = max(size.width(), size.height())
+        except AttributeError:
+            pass
+        
+        original = self.original if self.original is not None else self
+        for rendition in original.renditions:
+            if rendition.rendition_size >= size:
+                return rendition
+        return original
+
     @hybrid_property
     def display(self):
         return self.filename
@@ -158,15 +311,145 @@ class StoredFile(cbpos.database.Base, Item):
 
     @hybrid_property
     def path(self):
-        cache = self.cached()
-        if not os.path.isfile(cache):
-            with open(cache, 'wb') as f:
-                f.write(self.content)
-        return cache
+        from cbmod.base import cache
+        return cache.manager.get(self)
 
     def cached(self):
-        # TODO: do not use resources, use data (userdata) for files which can be modified
-        return cbpos.res.base('cache/{}{}'.format(self.id, self.filetype))
+        from cbmod.base import cache
+        return cache.manager.path_for(self.hash, self.filetype)
 
     def __repr__(self):
         return "<StoredFile %s>" % (self.filename,)
+
+# Files whose content was stored in the current transaction of each session.
+# They keep their source until it commits: when it is rolled back, so are the
+# blobs, and the content has to be stored again on the next flush
+_stored = weakref.WeakKeyDictionary()
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for target in _stored.pop(session, ()):
+        target._content_committed()
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    _stored.pop(session, None)
+
+@event.listens_for(StoredFile, 'before_insert')
+def _before_insert(mapper, connection, target):
+    target.store_content(connection)
+
+@event.listens_for(StoredFile, 'after_insert')
+def _after_insert(mapper, connection, target):
+    _expire_blob(target)
+
+@event.listens_for(StoredFile, 'before_update')
+def _before_update(mapper, connection, target):
+    # The new blob has to exist before the row references it
+    if attributes.get_history(target, 'hash').added:
+        target.store_content(connection)
+
+@event.listens_for(StoredFile, 'after_update')
+def _after_update(mapper, connection, target):
+    # The old blob is only released once the row does not reference it
+    history = attributes.get_history(target, 'hash')
+    if not history.added:
+        return
+    for hash in history.deleted:
+        if hash is not None:
+            StoredBlob.release(connection, hash)
+    _expire_blob(target)
+
+def _expire_blob(target):
+    """
+    The blob relationship is view-only: it is loaded again for the new hash.
+    """
+    session = object_session(target)
+    if session is not None:
+        session.expire(target, ['blob'])
+
+@event.listens_for(StoredFile, 'after_delete')
+def _after_delete(mapper, connection, target):
+    if target.hash is not None:
+        StoredBlob.release(connection, target.hash)
+
+class StoredFileReader(object):
+    """
+    Read-only file-like object over the chunks of a StoredFile.
+    """
+    
+    def __init__(self, chunks):
+        self.__chunks = chunks
+        self.__buffer = ''
+        self.closed = False
+    
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        
+        if size is None or size < 0:
+            data = self.__buffer + ''.join(self.__chunks)
+            self.__buffer = ''
+            return data
+        
+        parts = [self.__buffer]
+        length = len(self.__buffer)
+        while length < size:
+            try:
+                data = next(self.__chunks)
+            except StopIteration:
+                break
+            parts.append(data)
+            length += len(data)
+        
+        data = ''.join(parts)
+        self.__buffer = data[size:]
+        return data[:size]
+    
+    def __iter__(self):
+        if self.__buffer:
+            yield self.__buffer
+            self.__buffer = ''
+        for data in self.__chunks:
+            yield data
+    
+    def close(self):
+        self.closed = True
+        self.__chunks = iter([])
+        self.__buffer = ''
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class StoredFileWriter(object):
+    """
+    Write-only file-like object which replaces the content of a StoredFile.
+    The data is spooled to a temporary file once it grows past one chunk,
+    and stored (or deduplicated) on the next flush after the writer is closed.
+    """
+    
+    def __init__(self, storedfile):
+        self.storedfile = storedfile
+        self.__spool = tempfile.SpooledTemporaryFile(max_size=StoredBlob.CHUNK_SIZE)
+        self.closed = False
+    
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self.__spool.write(data)
+    
+    def close(self):
+        if self.closed:
+            return
+        
+        self.storedfile.content = self.__spool
+        self.closed = True
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
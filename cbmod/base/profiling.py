@@ -0,0 +1,355 @@
+"""
+Startup profiling: records the wall-clock time of the phases of the startup
+(creating the application, initializing the modules, building the main window
+and its pages...) and how much of it is spent importing modules.
+
+It is enabled by setting the COINBOX_PROFILE environment variable, to the
+path of the JSON report to write, or to 1 to only log the text report.
+It can also be enabled with the `profiling.enabled` configuration, in which
+case the report is written to `profiling.output` if set, but the imports done
+before the configuration was loaded are missed.
+
+Reports of two releases can be compared with:
+    coinbox-profile diff old.json new.json
+"""
+import os
+import sys
+import time
+import json
+import thread
+import functools
+import __builtin__
+
+import cbpos
+logger = cbpos.get_logger(__name__)
+
+ENV_VAR = 'COINBOX_PROFILE'
+
+REPORT_VERSION = 1
+
+class PhaseRecord(object):
+    __slots__ = ('name', 'category', 'start', 'duration', 'imports', 'depth')
+
+    def __init__(self, name, category, start, duration, imports, depth):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.duration = duration
+        self.imports = imports
+        self.depth = depth
+
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+class StartupProfiler(object):
+    """
+    Records phases, which can be nested, and the time spent importing each
+    module, from its creation until `finish` is called.
+    Only the imports done in the thread that installed the profiler are timed.
+    """
+
+    def __init__(self, output=None):
+        self.output = output
+        self.origin = time.time()
+        self.total = None
+
+        self.records = []
+        # Module name -> time spent importing it, excluding its own imports
+        self.imports = {}
+
+        self.__depth = 0
+        # Time spent in imports which were not done from other imports
+        self.__import_total = 0.0
+        # Time spent in the nested imports of each import being done
+        self.__import_stack = []
+        self.__original_import = None
+        self.__thread = None
+
+    @property
+    def finished(self):
+        return self.total is not None
+
+    def install(self):
+        """
+        Starts timing imports.
+        """
+        if self.__original_import is not None:
+            return
+        self.__thread = thread.get_ident()
+        self.__original_import = __builtin__.__import__
+        __builtin__.__import__ = self.__import
+
+    def uninstall(self):
+        if self.__original_import is None:
+            return
+        __builtin__.__import__ = self.__original_import
+        self.__original_import = None
+
+    def __import(self, name, globals=None, *args, **kwargs):
+        if thread.get_ident() != self.__thread:
+            return self.__original_import(name, globals, *args, **kwargs)
+
+        count = len(sys.modules)
+        self.__import_stack.append(0.0)
+        start = time.time()
+        try:
+            return self.__original_import(name, globals, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = self.__import_stack.pop()
+            if self.__import_stack:
+                self.__import_stack[-1] += elapsed
+            else:
+                self.__import_total += elapsed
+
+            if len(sys.modules) > count:
+                # Something was actually loaded, not only looked up
+                module = self.__module_name(name, globals)
+                self.imports[module] = self.imports.get(module, 0.0) + elapsed - nested
+
+    @staticmethod
+    def __module_name(name, globals):
+        """
+        Returns the absolute name of the imported module, which may be
+        relative to the package of the importer.
+        """
+        if globals:
+            package = globals.get('__package__') or globals.get('__name__')
+            if package and name and not name.startswith(package+'.'):
+                relative = package+'.'+name
+                if sys.modules.get(relative) is not None:
+                    return relative
+        return name or (globals or {}).get('__package__') or ''
+
+    def phase(self, name, category='phase'):
+        return _Phase(self, name, category)
+
+    def _enter(self):
+        depth = self.__depth
+        self.__depth += 1
+        return depth, time.time(), self.__import_total
+
+    def _exit(self, name, category, state):
+        depth, start, imports = state
+        self.__depth -= 1
+        self.records.append(PhaseRecord(name, category,
+                                        start - self.origin,
+                                        time.time() - start,
+                                        self.__import_total - imports,
+                                        depth))
+
+    def finish(self):
+        """
+        Stops profiling, logs the report and writes it to `output` if set.
+        """
+        if self.finished:
+            return
+        self.uninstall()
+        self.total = time.time() - self.origin
+
+        logger.info('Startup profile:\n%s', format_report(self.report()))
+
+        if self.output:
+            try:
+                with open(self.output, 'w') as f:
+                    json.dump(self.report(), f, indent=1, sort_keys=True)
+            except (IOError, OSError):
+                logger.exception('Could not write the startup profile to %s', self.output)
+            else:
+                logger.info('Startup profile written to %s', self.output)
+
+    def report(self):
+        """
+        Returns the report as a dict, which can be serialized to JSON.
+        """
+        total = self.total if self.finished else time.time() - self.origin
+        return {'version': REPORT_VERSION,
+                'total': total,
+                'imports_total': self.__import_total,
+                'phases': [r.as_dict() for r in sorted(self.records, key=lambda r: (r.start, r.depth))],
+                'imports': self.imports
+                }
+
+class _Phase(object):
+    """
+    Context manager recording one phase of a StartupProfiler.
+    """
+    __slots__ = ('profiler', 'name', 'category', 'state')
+
+    def __init__(self, profiler, name, category):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.state = None
+
+    def __enter__(self):
+        self.state = self.profiler._enter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.profiler._exit(self.name, self.category, self.state)
+        return False
+
+class _NoPhase(object):
+    """
+    Context manager doing nothing, used when profiling is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_no_phase = _NoPhase()
+
+def format_report(report, imports=20):
+    """
+    Formats a report as text, with the `imports` slowest module imports.
+    """
+    lines = ['Total: {:.3f}s, of which imports: {:.3f}s'.format(report['total'], report['imports_total']),
+             '',
+             '{:>9} {:>9} {:>9}  {}'.format('start', 'wall', 'import', 'phase')]
+    for phase in report['phases']:
+        lines.append('{:>8.3f}s {:>8.3f}s {:>8.3f}s  {}{} [{}]'.format(phase['start'],
+                                                         phase['duration'],
+                                                         phase['imports'],
+                                                         '  '*phase['depth'],
+                                                         phase['name'],
+                                                         phase['category']))
+
+    slowest = sorted(report['imports'].iteritems(), key=lambda (m, t): t, reverse=True)[:imports]
+    if slowest:
+        lines += ['', '{:>9}  {}'.format('import', 'module')]
+        lines.extend('{:>8.3f}s  {}'.format(t, m) for m, t in slowest)
+    return '\n'.join(lines)
+
+def diff_reports(old, new):
+    """
+    Compares two reports. Returns a list of (kind, name, old, new) where kind
+    is 'total', 'phase' or 'import' and old or new are None if missing.
+    Phases with the same name are summed.
+    """
+    def phases(report):
+        totals = {}
+        for phase in report['phases']:
+            key = '{} [{}]'.format(phase['name'], phase['category'])
+            totals[key] = totals.get(key, 0.0) + phase['duration']
+        return totals
+
+    rows = [('total', 'total', old['total'], new['total']),
+            ('total', 'imports', old['imports_total'], new['imports_total'])]
+    for kind, old_values, new_values in (('phase', phases(old), phases(new)),
+                                         ('import', old['imports'], new['imports'])):
+        for name in sorted(set(old_values) | set(new_values)):
+            rows.append((kind, name, old_values.get(name), new_values.get(name)))
+    return rows
+
+def format_diff(rows, threshold=0.0):
+    """
+    Formats the result of diff_reports as text, leaving out the phases
+    and imports which changed by less than `threshold` seconds.
+    """
+    def fmt(value):
+        return '{:>8.3f}s'.format(value) if value is not None else '{:>9}'.format('-')
+
+    lines = ['{:>9} {:>9} {:>9}  {}'.format('old', 'new', 'delta', 'name')]
+    for kind, name, old, new in rows:
+        delta = (new or 0.0) - (old or 0.0)
+        if kind != 'total' and abs(delta) < threshold:
+            continue
+        lines.append('{} {} {:>+8.3f}s  {} {}'.format(fmt(old), fmt(new), delta, kind, name))
+    return '\n'.join(lines)
+
+profiler = None
+
+def start(output=None):
+    """
+    Starts profiling, if it was not already, and returns the profiler.
+    """
+    global profiler
+    if profiler is None:
+        profiler = StartupProfiler(output)
+        profiler.install()
+    elif output and not profiler.output:
+        profiler.output = output
+    return profiler
+
+def start_from_environ():
+    value = os.environ.get(ENV_VAR, '')
+    if value:
+        start(None if value == '1' else value)
+
+def start_from_config():
+    if cbpos.config['profiling', 'enabled']:
+        start(cbpos.config['profiling', 'output'] or None)
+
+def enabled():
+    return profiler is not None and not profiler.finished
+
+def phase(name, category='phase'):
+    """
+    Returns a context manager recording the phase `name`, which does nothing
+    if profiling is not enabled.
+    """
+    if profiler is None or profiler.finished:
+        return _no_phase
+    return profiler.phase(name, category)
+
+def timed(name=None, category='phase'):
+    """
+    Decorator recording every call of the function as a phase.
+    """
+    def decorator(func):
+        phase_name = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(phase_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def finish():
+    if profiler is not None:
+        profiler.finish()
+
+def main(argv=None):
+    """
+    Console entry point: shows a report, or compares two of them.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Show or compare Coinbox startup profiles.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    show_parser = subparsers.add_parser('show', help='show a report')
+    show_parser.add_argument('report', help='JSON report')
+    show_parser.add_argument('--imports', type=int, default=20,
+                             help='number of slowest imports to show')
+
+    diff_parser = subparsers.add_parser('diff', help='compare two reports')
+    diff_parser.add_argument('old', help='JSON report of the reference')
+    diff_parser.add_argument('new', help='JSON report to compare to the reference')
+    diff_parser.add_argument('--threshold', type=float, default=0.001,
+                             help='hide changes smaller than this many seconds')
+    args = parser.parse_args(argv)
+
+    def load(path):
+        with open(path) as f:
+            report = json.load(f)
+        if report.get('version') != REPORT_VERSION:
+            parser.error('unsupported report version in {}'.format(path))
+        return report
+
+    if args.command == 'show':
+        sys.stdout.write(format_report(load(args.report), args.imports)+'\n')
+    else:
+        rows = diff_reports(load(args.old), load(args.new))
+        sys.stdout.write(format_diff(rows, args.threshold)+'\n')
+    return 0
+
+# Start as early as possible, which is when this module is first imported
+start_from_environ()
+
+if __name__ == '__main__':
+    sys.exit(main())
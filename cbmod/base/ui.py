@@ -6,6 +6,8 @@ from collections import defaultdict
 import cbpos
 logger = cbpos.get_logger(__name__)
 
+from cbmod.base import profiling
+
 class QtUIHandler(cbpos.BaseUIHandler):
     application = None
     extensions = None
@@ -105,7 +107,8 @@ class QtUIHandler(cbpos.BaseUIHandler):
         logger.info('PySide: %s' % (PySide.__version_info__,))
         
         logger.debug('Creating application instance...')
-        self.application = QtGui.QApplication(sys.argv)
+        with profiling.phase('QtUIHandler.init'):
+            self.application = QtGui.QApplication(sys.argv)
         return True
     
     def handle_first_run(self):
@@ -135,8 +138,13 @@ class QtUIHandler(cbpos.BaseUIHandler):
         return self.application.exec_()
     
     def __load_default_main_window(self):
+        with profiling.phase('QtUIHandler.load_default_main_window'):
+            self.__do_load_default_main_window()
+    
+    def __do_load_default_main_window(self):
         logger.debug('Importing main window...')
-        from cbmod.base.views import MainWindow as BaseMainWindow
+        with profiling.phase('import main window'):
+            from cbmod.base.views import MainWindow as BaseMainWindow
         
         if len(self.extensions) > 0:
             logger.debug('Loading main window extensions...')
@@ -160,7 +168,8 @@ class QtUIHandler(cbpos.BaseUIHandler):
             MainWindow = BaseMainWindow
         
         logger.debug('Loading main window %s...', MainWindow.__name__)
-        self.__window = MainWindow()
+        with profiling.phase('MainWindow()'):
+            self.__window = MainWindow()
     
     def __show_main_window(self):
         if self.__window is None:
@@ -168,7 +177,14 @@ class QtUIHandler(cbpos.BaseUIHandler):
         else:
             logger.debug('Main Window is not the default: ' + repr(self.__window))
         
-        return self.__show_window(self.__window)
+        with profiling.phase('show main window'):
+            win = self.__show_window(self.__window)
+        
+        if profiling.enabled():
+            # Stop once the main window got painted, when the event loop is running
+            QtCore.QTimer.singleShot(0, profiling.finish)
+        
+        return win
     
     def __show_window(self, win):
         """
@@ -1,5 +1,15 @@
-from .page import BasePage
-from .form import FormPage
-from .window import MainWindow
-from .wizard import BaseWizard, BaseWizardPage, FirstTimeWizard
-from .config import AppConfigPage, MenuConfigPage, LocaleConfigPage, PrintingConfigPage
+from cbmod.base.lazy import lazy_package
+
+# The views are only imported when they are first used
+lazy_package(__name__, {
+    'BasePage': '.page',
+    'FormPage': '.form',
+    'MainWindow': '.window',
+    'BaseWizard': '.wizard',
+    'BaseWizardPage': '.wizard',
+    'FirstTimeWizard': '.wizard',
+    'AppConfigPage': '.config',
+    'MenuConfigPage': '.config',
+    'LocaleConfigPage': '.config',
+    'PrintingConfigPage': '.config',
+    })
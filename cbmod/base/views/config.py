@@ -143,8 +143,18 @@ class PrintingForm(FormPage):
     def widgets(self):
         name = QtGui.QLineEdit()
         
-        setup = QtGui.QPushButton('Set up')
-        setup.clicked.connect(self.onSetUpClicked)
+        setup_qt = QtGui.QPushButton('Set up')
+        setup_qt.clicked.connect(self.onSetUpClicked)
+        
+        setup_escpos = QtGui.QPushButton('Set up ESC/POS')
+        setup_escpos.clicked.connect(self.onSetUpEscPosClicked)
+        
+        setup = QtGui.QWidget()
+        buttons = QtGui.QHBoxLayout()
+        buttons.setContentsMargins(0, 0, 0, 0)
+        buttons.addWidget(setup_qt)
+        buttons.addWidget(setup_escpos)
+        setup.setLayout(buttons)
         
         info = QtGui.QTextEdit()
         info.setReadOnly(True)
@@ -165,6 +175,17 @@ class PrintingForm(FormPage):
         self.setDataOnControl('printer', printer)
         self.setDataOnControl('info', printer)
     
+    def onSetUpEscPosClicked(self):
+        from cbmod.base.controllers import printing
+        if self.__printer is None:
+            printer = printing.manager.prompt_escpos_printer('printer')
+        else:
+            printer = printing.manager.prompt_escpos_printer(self.__printer.name, self.__printer)
+        
+        if printer is not None:
+            self.setDataOnControl('printer', printer)
+            self.setDataOnControl('info', printer)
+    
     def getDataFromControl(self, field):
         if field == 'name':
             data = self.f[field].text()
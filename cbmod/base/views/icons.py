@@ -0,0 +1,172 @@
+import os
+from collections import OrderedDict
+
+from PySide import QtCore, QtGui
+
+import cbpos
+logger = cbpos.get_logger(__name__)
+
+def load_image(path, size=None):
+    """
+    Decodes the image at `path`, scaled down to fit in `size` while decoding
+    so that no more pixels than necessary are held in memory.
+    Returns a QImage, which is null if the image could not be read.
+    """
+    reader = QtGui.QImageReader(path)
+    if size is not None:
+        original = reader.size()
+        if original.isValid() and (original.width() > size.width() or original.height() > size.height()):
+            reader.setScaledSize(original.scaled(size, QtCore.Qt.KeepAspectRatio))
+    return reader.read()
+
+class IconCache(object):
+    """
+    Memory-bounded cache of decoded icons, least recently used first out.
+    Icons are keyed by their source (a StoredFile or a path) and size, so
+    that the same image is only decoded once for every size it is shown in.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+
+        # key -> (icon, cost)
+        self.__entries = OrderedDict()
+        self.__total = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls):
+        try:
+            max_size = int(cbpos.config['cache', 'icons_max_size'])
+        except (ValueError, TypeError):
+            max_size = 0
+        return cls(max_size)
+
+    @staticmethod
+    def key(source, size=None):
+        """
+        Returns the cache key for this source and size,
+        or None if it cannot be cached.
+        """
+        if isinstance(source, basestring):
+            source_key = ('path', source)
+        else:
+            try:
+                source_key = ('hash', source.hash)
+            except AttributeError:
+                return None
+
+        if size is None:
+            return source_key + (None,)
+        else:
+            return source_key + ((size.width(), size.height()),)
+
+    @staticmethod
+    def best_source(source, size=None):
+        """
+        Returns the rendition of `source` that is best for `size`,
+        or `source` itself if it has none.
+        """
+        if size is not None:
+            try:
+                # Never decode more pixels than will be shown
+                return source.rendition(size)
+            except AttributeError:
+                pass
+        return source
+
+    @staticmethod
+    def source_path(source):
+        if isinstance(source, basestring):
+            return source
+        else:
+            # A StoredFile
+            return source.path
+
+    def get(self, key):
+        """
+        Returns the cached icon for this `key`, or None.
+        """
+        try:
+            icon, cost = self.__entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        else:
+            self.__entries[key] = (icon, cost)
+            self.hits += 1
+            return icon
+
+    def put(self, key, icon, cost):
+        old = self.__entries.pop(key, None)
+        if old is not None:
+            self.__total -= old[1]
+
+        self.__entries[key] = (icon, cost)
+        self.__total += cost
+
+        if self.max_size > 0:
+            while self.__total > self.max_size and len(self.__entries) > 1:
+                _, (_, old_cost) = self.__entries.popitem(last=False)
+                self.__total -= old_cost
+
+    def put_image(self, key, image):
+        """
+        Caches an icon made of the decoded QImage `image` and returns it.
+        """
+        if image.isNull():
+            icon = QtGui.QIcon()
+        else:
+            icon = QtGui.QIcon(QtGui.QPixmap.fromImage(image))
+        self.put(key, icon, image.byteCount())
+        return icon
+
+    def icon(self, source, size=None):
+        """
+        Returns a QIcon for `source`, which is either a StoredFile or a path,
+        decoded at `size` (a QSize) if given.
+        """
+        if not source:
+            return QtGui.QIcon()
+        elif isinstance(source, QtGui.QIcon):
+            return source
+        elif isinstance(source, QtGui.QPixmap):
+            return QtGui.QIcon(source)
+
+        source = self.best_source(source, size)
+        key = self.key(source, size)
+        if key is None:
+            return QtGui.QIcon(source)
+
+        icon = self.get(key)
+        if icon is not None:
+            return icon
+
+        path = self.source_path(source)
+        if size is None:
+            # Let QIcon load it when it is needed
+            icon = QtGui.QIcon(path)
+            try:
+                cost = os.path.getsize(path)
+            except (OSError, TypeError):
+                cost = 0
+            self.put(key, icon, cost)
+            return icon
+        else:
+            return self.put_image(key, load_image(path, size))
+
+    def clear(self):
+        self.__entries.clear()
+        self.__total = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.__entries),
+                'size': self.__total,
+                'max_size': self.max_size
+                }
+
+manager = None
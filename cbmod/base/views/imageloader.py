@@ -0,0 +1,123 @@
+from PySide import QtCore, QtGui
+
+import cbpos
+logger = cbpos.get_logger(__name__)
+
+from cbmod.base.views import icons
+
+class ImageLoadTask(QtCore.QRunnable):
+    def __init__(self, loader, key, path, size):
+        super(ImageLoadTask, self).__init__()
+        # The task is emitted to the GUI thread, so the pool must not delete
+        # it when it is done: the loader keeps it until it is handled
+        self.setAutoDelete(False)
+        self.loader = loader
+        self.key = key
+        self.path = path
+        self.size = size
+        # Requests waiting for the image
+        self.requests = []
+        # Set in the GUI thread once no request waits for the image
+        self.cancelled = False
+    
+    def run(self):
+        if self.cancelled:
+            # Cancelled while waiting in the queue
+            image = QtGui.QImage()
+        else:
+            # QImage, unlike QPixmap, is safe to use outside the GUI thread
+            image = icons.load_image(self.path, self.size)
+        self.loader.decoded.emit(self, image)
+
+class ImageLoader(QtCore.QObject):
+    """
+    Decodes images in a thread pool and emits `loaded` with the icon
+    for each request once it is ready, in the GUI thread.
+    Already cached icons are returned right away.
+    """
+    
+    # request, icon
+    loaded = QtCore.Signal(int, QtGui.QIcon)
+    # Emitted by the tasks from the pool threads
+    decoded = QtCore.Signal(object, QtGui.QImage)
+    
+    def __init__(self, parent=None, pool=None):
+        super(ImageLoader, self).__init__(parent)
+        
+        self.pool = QtCore.QThreadPool.globalInstance() if pool is None else pool
+        
+        self.__last_request = 0
+        # key -> task decoding it
+        self.__pending = {}
+        # request -> task it waits for
+        self.__requests = {}
+        # Keep a reference to the tasks for as long as they run
+        self.__tasks = set()
+        
+        self.decoded.connect(self.onDecoded)
+    
+    def load(self, source, size=None):
+        """
+        Loads the icon for `source`, a StoredFile or a path, at `size`.
+        Returns (request, icon): icon is None if it is being loaded
+        and will be emitted later with this request number.
+        """
+        source = icons.manager.best_source(source, size)
+        key = icons.manager.key(source, size)
+        if key is None:
+            return (None, icons.manager.icon(source, size))
+        
+        icon = icons.manager.get(key)
+        if icon is not None:
+            return (None, icon)
+        
+        # Materializing a StoredFile hits the database, so do it here
+        path = icons.manager.source_path(source)
+        
+        self.__last_request += 1
+        request = self.__last_request
+        
+        task = self.__pending.get(key)
+        if task is None:
+            task = self.__pending[key] = ImageLoadTask(self, key, path, size)
+            self.__tasks.add(task)
+            self.pool.start(task)
+        task.requests.append(request)
+        self.__requests[request] = task
+        
+        return (request, None)
+    
+    def forget(self, request):
+        """
+        Forget about a pending request. If no other request waits for the
+        same image and its task did not start yet, it will not decode it.
+        """
+        task = self.__requests.pop(request, None)
+        if task is None:
+            return
+        
+        task.requests.remove(request)
+        if not task.requests:
+            task.cancelled = True
+            del self.__pending[task.key]
+    
+    def cancel(self):
+        """
+        Forget about all the pending requests.
+        Tasks that did not start yet will not decode anything.
+        """
+        for task in self.__pending.itervalues():
+            task.cancelled = True
+        self.__pending.clear()
+        self.__requests.clear()
+    
+    def onDecoded(self, task, image):
+        self.__tasks.discard(task)
+        if task.cancelled:
+            return
+        
+        del self.__pending[task.key]
+        icon = icons.manager.put_image(task.key, image)
+        for request in task.requests:
+            del self.__requests[request]
+            self.loaded.emit(request, icon)
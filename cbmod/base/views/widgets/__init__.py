@@ -1,2 +1,6 @@
-from .catalog import Catalog
-from .imagepicker import ImagePicker
\ No newline at end of file
+from cbmod.base.lazy import lazy_package
+
+lazy_package(__name__, {
+    'Catalog': '.catalog',
+    'ImagePicker': '.imagepicker',
+    })
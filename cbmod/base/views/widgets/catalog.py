@@ -1,15 +1,187 @@
 from PySide import QtGui, QtCore
 
+import time
+from collections import OrderedDict
+
 import cbpos
+logger = cbpos.get_logger(__name__)
+
+from cbmod.base.views.widgets.catalogmodel import CatalogModel, CatalogRow, PagedSource, \
+    PARENT, CHILD, UP, ALL, ITEM, TYPE
+from cbmod.base.views.widgets.searchindex import SearchIndex
+
+class SearchTask(QtCore.QRunnable):
+    """
+    Runs the query of a search and fetches its first page in a pool thread.
+    """
+    
+    def __init__(self, catalog, generation, level, search):
+        super(SearchTask, self).__init__()
+        # Emitted to the GUI thread when done, the catalog keeps it until then
+        self.setAutoDelete(False)
+        self.catalog = catalog
+        self.generation = generation
+        self.level = level
+        self.search = search
+    
+    def run(self):
+        try:
+            sources = self.catalog.querySources(self.level, self.search)
+            rows = []
+            for source in sources:
+                if len(rows) >= CatalogModel.PAGE_SIZE:
+                    break
+                rows.extend(source.fetch(CatalogModel.PAGE_SIZE - len(rows)))
+        except Exception:
+            logger.exception("Search failed in the background")
+            rows, sources = None, None
+        self.catalog.searchDone.emit(self, rows, sources)
 
-PARENT, CHILD, UP, ALL = 0, 1, 2, 3
-ITEM, TYPE = QtCore.Qt.UserRole+1, QtCore.Qt.UserRole+2
+class PrefetchTask(QtCore.QRunnable):
+    """
+    Fetches all the children of a parent in a pool thread,
+    unless there are more than `limit` of them.
+    """
+    
+    def __init__(self, catalog, epoch, level, limit):
+        super(PrefetchTask, self).__init__()
+        # Emitted to the GUI thread when done, the catalog keeps it until then
+        self.setAutoDelete(False)
+        self.catalog = catalog
+        self.epoch = epoch
+        self.level = level
+        self.limit = limit
+    
+    def run(self):
+        rows = []
+        try:
+            for source in self.catalog.querySources(self.level, None):
+                rows.extend(source.fetch(self.limit + 1 - len(rows)))
+                if len(rows) > self.limit:
+                    rows = None
+                    break
+        except Exception:
+            logger.exception("Prefetch failed in the background")
+            rows = None
+        self.catalog.prefetchDone.emit(self, rows)
+
+class CatalogListItem(object):
+    """
+    Row of the catalog list, with the QListWidgetItem methods that
+    subclasses of Catalog used when the list was a QListWidget.
+    """
+    
+    def __init__(self, model, row):
+        self.model = model
+        self.row = row
+    
+    def text(self):
+        return self.row.label
+    
+    def icon(self):
+        return self.model.rowIcon(self.row)
+    
+    def data(self, role):
+        if role == ITEM:
+            return self.row.data
+        elif role == TYPE:
+            return self.row.type
+        elif role == QtCore.Qt.DisplayRole:
+            return self.row.label
+        return None
+
+class CatalogListView(QtGui.QListView):
+    """
+    List of the catalog. It used to be a QListWidget, whose methods to
+    read and add items are still available on top of the model.
+    """
+    
+    itemActivated = QtCore.Signal(object)
+    
+    def __init__(self, parent=None):
+        super(CatalogListView, self).__init__(parent)
+        self.activated.connect(self.onActivated)
+    
+    def onActivated(self, index):
+        self.itemActivated.emit(self.item(index.row()))
+    
+    def addItem(self, item):
+        """
+        Appends `item`, a label or a QListWidgetItem, to the list.
+        """
+        if isinstance(item, basestring):
+            row = CatalogRow(item, None, None, CHILD)
+        else:
+            t = item.data(TYPE)
+            row = CatalogRow(item.text(), None, item.data(ITEM), CHILD if t is None else t)
+            if not item.icon().isNull():
+                row.icon = item.icon()
+        self.model().appendRow(row)
+    
+    def clear(self):
+        self.model().reset([])
+    
+    def count(self):
+        return self.model().rowCount()
+    
+    def item(self, row):
+        if not 0 <= row < self.model().rowCount():
+            return None
+        return CatalogListItem(self.model(), self.model().row(row))
+    
+    def currentRow(self):
+        return self.currentIndex().row()
+    
+    def setCurrentRow(self, row):
+        self.setCurrentIndex(self.model().index(row))
+    
+    def currentItem(self):
+        return self.item(self.currentRow())
 
 class Catalog(QtGui.QWidget):
+    """
+    Browsable and searchable list of items and their parents (categories).
+    Subclasses define `getAll` and `getChildren`.
+    
+    When `background_search` is set, the searches typed in the search box
+    call them in a pool thread, and the GUI thread then keeps fetching from
+    what they return. Only set it if that is safe: they must not use the
+    session of the GUI thread, e.g. they return plain objects, not queries.
+    """
+    
+    # Run the searches typed in the search box in a pool thread
+    background_search = False
+    # Milliseconds to wait after the last keystroke before searching.
+    # Keystrokes less than scanner_interval ms apart come from a barcode
+    # scanner, which is waited for scanner_delay ms instead.
+    search_delay = 200
+    scanner_delay = 50
+    scanner_interval = 30
+    
+    # Refine the previous results in memory when the search text grows.
+    # Only enable it if getAll/getChildren match the display of the items
+    # by case-insensitive substring, and nothing else (codes, barcodes...).
+    incremental_search = False
+    # Do not index searches with more results than this
+    search_index_limit = 1000
+    
+    # Number of levels (a parent and a search) kept in memory to navigate
+    # back to them without querying, and the most rows a level can have.
+    # Off by default: subclasses which enable it call invalidateCache
+    # when their items change.
+    level_cache_size = 0
+    level_cache_limit = 500
+    # Fetch the children of the parents shown in the background, so that
+    # opening them does not hit the database. Needs the level cache, and
+    # has the same caveats as background_search.
+    prefetch_children = False
     
     childSelected = QtCore.Signal('QVariant')
     parentSelected = QtCore.Signal('QVariant')
     searchChanged = QtCore.Signal(str)
+    # Emitted by the search tasks from the pool thread
+    searchDone = QtCore.Signal(object, object, object)
+    prefetchDone = QtCore.Signal(object, object)
     
     def __init__(self):
         super(Catalog, self).__init__()
@@ -19,6 +191,34 @@ class Catalog(QtGui.QWidget):
         self.search.textChanged.connect(self.onSearchTextChanged)
         self.search.returnPressed.connect(self.onSearchReturnPressed)
         
+        for option in ('search_delay', 'scanner_delay', 'scanner_interval'):
+            try:
+                setattr(self, option, int(cbpos.config['catalog', option]))
+            except (ValueError, TypeError):
+                pass
+        
+        # Restarted on every keystroke, so only the last one triggers a search
+        self.searchTimer = QtCore.QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.timeout.connect(self.doSearch)
+        self.__last_keystroke = 0
+        
+        # One search at a time, the results of the previous ones are dropped
+        self.searchPool = QtCore.QThreadPool(self)
+        self.searchPool.setMaxThreadCount(1)
+        self.searchDone.connect(self.onSearchDone)
+        self.prefetchDone.connect(self.onPrefetchDone)
+        self.__generation = 0
+        self.__tasks = set()
+        
+        # (level, search) -> rows, least recently used first
+        self.__levels = OrderedDict()
+        # (level, search) of the rows shown
+        self.__shown = None
+        # Incremented when the cache is invalidated
+        self.__epoch = 0
+        self.__prefetching = set()
+        
         icon = QtGui.QIcon.fromTheme('edit-clear')
         
         if icon.isNull():
@@ -28,9 +228,12 @@ class Catalog(QtGui.QWidget):
             self.clearBtn.setIcon(icon)
         self.clearBtn.pressed.connect(self.onSearchClear)
         
-        self.list = QtGui.QListWidget()
-        self.list.setViewMode(QtGui.QListWidget.IconMode)
-        self.list.itemActivated.connect(self.onListItemActivated)
+        self.list = CatalogListView()
+        self.list.setViewMode(QtGui.QListView.IconMode)
+        self.list.setResizeMode(QtGui.QListView.Adjust)
+        self.list.setMovement(QtGui.QListView.Static)
+        self.list.setUniformItemSizes(True)
+        self.list.activated.connect(self.onListItemActivated)
         self.list.setIconSize(QtCore.QSize(128, 128))
         
         top = QtGui.QHBoxLayout()
@@ -47,96 +250,268 @@ class Catalog(QtGui.QWidget):
                       PARENT: QtGui.QIcon.fromTheme('folder'),
                       ALL: QtGui.QIcon.fromTheme('package-x-generic')}
         
+        self.model = CatalogModel(self.icons, self.list.iconSize(), self)
+        self.list.setModel(self.model)
+        
         self.show_all = True
         self.in_all = False
         
         self.__current = None
         self.__tree = []
-        self.__display = [[], []]
+        self.__index = None
+        # (level, search) of the results shown, to index once they are refined
+        self.__indexable = None
 
     def populate(self, parent=None, search=None, show_all=False):
+        self.__cacheShown()
+        # Drop the results of the searches still running
+        self.__generation += 1
+        
+        level = self.__setLevel(parent, search, show_all)
+        if self.__refineSearch(level, search):
+            return
+        
+        rows = self.__levels.get((level, search))
+        if rows is not None:
+            # Visited recently
+            self.__show(level, search, rows, [])
+            return
+        
+        self.__show(level, search, [], self.querySources(level, search))
+
+    def __setLevel(self, parent, search, show_all):
         self.__current = parent
         self.__search = search
         self.in_all = show_all
         
-        if self.in_all or (parent is None and search is not None):
+        in_all = self.in_all or (parent is None and search is not None)
+        return (in_all, None if in_all else parent)
+
+    def querySources(self, level, search):
+        """
+        Returns the PagedSource's of the parents and children to show on `level`.
+        """
+        in_all, parent = level
+        if in_all:
             parents, children = [], self.getAll(search=search)
         else:
             parents, children = self.getChildren(parent=parent, search=search)
+        return [PagedSource(parents, PARENT), PagedSource(children, CHILD)]
+
+    def __refineSearch(self, level, search):
+        if not self.incremental_search:
+            return False
         
-        # If iterators are used (i.e. Query objects), they cannot be
-        # iterated over more than once. So we need to convert them to lists.
-        parents, children = list(parents), list(children)
+        index = self.__searchIndex()
+        if index is None or not index.covers(level, search):
+            return False
         
-        self.list.clear()
+        self.model.icon_size = self.list.iconSize()
+        self.model.update(index.search(search))
+        self.__shown = (level, search)
+        return True
+    
+    def __searchIndex(self):
+        """
+        Returns the index of the search results shown. It is only built when
+        they are refined, and only from the rows the list already fetched.
+        """
+        if self.__index is not None or self.__indexable is None \
+                or self.model.canFetchMore():
+            return self.__index
         
+        rows = [r for r in self.model.rows if r.type in (PARENT, CHILD)]
+        if len(rows) <= self.search_index_limit:
+            level, search = self.__indexable
+            self.__index = SearchIndex(level, search, rows)
+        self.__indexable = None
+        return self.__index
+
+    def __show(self, level, search, rows, sources):
+        fixed = []
         if search is None:
-            if parent is not None or self.in_all:
-                self.addItem("[Up]", None, None, UP)
+            if self.__current is not None or self.in_all:
+                fixed.append(CatalogRow("[Up]", None, None, UP))
             elif self.show_all:
-                self.addItem("[All]", None, None, ALL)
+                fixed.append(CatalogRow("[All]", None, None, ALL))
         
-        for data in parents:
-            try:
-                item, image = data
-            except (TypeError, ValueError):
-                item = data
-                image = None
-            self.addItem(item.display, image, item, PARENT)
+        # Rows are only fetched from parents and children (which may be
+        # Query objects) as the list is scrolled, see CatalogModel
+        self.model.icon_size = self.list.iconSize()
+        # Only the rows that changed since the last time are replaced
+        self.model.update(fixed + rows, sources)
         
-        for data in children:
-            try:
-                item, image = data
-            except (TypeError, ValueError):
-                item = data
-                image = None
-            self.addItem(item.display, image, item, CHILD)
+        self.__shown = (level, search)
+        # The search index is built from these rows when they are refined
+        self.__index = None
+        self.__indexable = (level, search) if self.incremental_search and search is not None else None
+        
+        self.__cacheShown()
+        self.__prefetch()
+
+    def __cacheShown(self):
+        """
+        Keep the rows shown in the cache, if the list already fetched all
+        of them (they fit in the first page or were scrolled through) and
+        there are not too many of them.
+        """
+        if self.level_cache_size <= 0 or self.__shown is None \
+                or self.model.canFetchMore():
+            return
+        
+        level, search = self.__shown
+        if level == (True, None) and search is None:
+            # The whole catalog
+            return
+        
+        rows = [r for r in self.model.rows if r.type in (PARENT, CHILD)]
+        if len(rows) <= self.level_cache_limit:
+            self.__cacheLevel(self.__shown, rows)
+    
+    def __cacheLevel(self, key, rows):
+        if self.level_cache_size <= 0:
+            return
+        
+        self.__levels.pop(key, None)
+        self.__levels[key] = rows
+        while len(self.__levels) > self.level_cache_size:
+            self.__levels.popitem(last=False)
+    
+    def __prefetch(self):
+        if not self.prefetch_children or self.level_cache_size <= 0:
+            return
+        
+        for row in self.model.rows[:CatalogModel.PAGE_SIZE]:
+            if row.type != PARENT:
+                continue
+            
+            level = (False, row.data)
+            if (level, None) in self.__levels or level in self.__prefetching:
+                continue
+            
+            self.__prefetching.add(level)
+            task = PrefetchTask(self, self.__epoch, level, self.level_cache_limit)
+            self.__tasks.add(task)
+            # Searches go first
+            self.searchPool.start(task, -1)
+    
+    def onPrefetchDone(self, task, rows):
+        self.__tasks.discard(task)
+        self.__prefetching.discard(task.level)
+        if task.epoch != self.__epoch or rows is None:
+            return
+        
+        key = (task.level, None)
+        if key not in self.__levels:
+            self.__cacheLevel(key, rows)
+    
+    def invalidateSearchIndex(self):
+        """
+        Call when the items change, so that the next search is not
+        answered from the previous results.
+        """
+        self.__index = None
+        self.__indexable = None
+    
+    def invalidateCache(self, *parents):
+        """
+        Call when the items change, so that they are queried again.
+        Only the levels of `parents` (and the searches in the whole catalog)
+        are dropped if given, everything otherwise.
+        """
+        self.__epoch += 1
+        self.__prefetching.clear()
+        self.invalidateSearchIndex()
+        # The rows shown are out of date too
+        self.__shown = None
+        
+        if not parents:
+            self.__levels.clear()
+            return
         
-        self.__display = [parents, children]
+        for key in list(self.__levels):
+            (in_all, parent), search = key
+            if in_all or parent in parents:
+                del self.__levels[key]
 
     def addItem(self, label, image, data, t):
-        item = QtGui.QListWidgetItem(label)
-        item.setData(ITEM, data)
-        item.setData(TYPE, t)
-        if image:
-            icon = QtGui.QIcon(image)
-            item.setIcon(icon)
-        else:
-            item.setIcon(self.icons[t])
-        return self.list.addItem(item)
+        return self.model.appendRow(CatalogRow(label, image, data, t))
 
     def onSearchTextChanged(self):
-        QtCore.QTimer.singleShot(200, lambda s=self.search.text(): self.checkSearch(s))
-    
-    def checkSearch(self, last):
-        if last == self.search.text():
-            self.doSearch()
+        now = time.time()
+        interval = (now - self.__last_keystroke) * 1000
+        self.__last_keystroke = now
+        
+        if interval < self.scanner_interval:
+            self.searchTimer.start(self.scanner_delay)
+        else:
+            self.searchTimer.start(self.search_delay)
     
     def onSearchReturnPressed(self):
-        self.doSearch()
+        # The results are needed right away
+        self.doSearch(background=False)
         
-        parents, children = self.__display
-        if len(parents) == 0 and len(children) == 1:
-            data, label = children[0]
-            self.childSelected.emit(data)
-        elif len(parents) == 1 and len(children) == 0:
-            data, label = parents[0]
-            self.parentSelected.emit(data)
+        # Only fetch what is needed to know if there is a single result
+        self.model.fetchAtLeast(3)
+        rows = [r for r in self.model.rows if r.type in (PARENT, CHILD)]
+        if len(rows) != 1 or self.model.canFetchMore():
+            return
+        
+        if rows[0].type == CHILD:
+            self.childSelected.emit(rows[0].data)
+        else:
+            self.parentSelected.emit(rows[0].data)
     
     def onSearchClear(self):
         self.search.setText('')
         self.doSearch()
     
-    def doSearch(self):
+    def doSearch(self, background=None):
+        self.searchTimer.stop()
+        if background is None:
+            background = self.background_search
+        
         s = self.search.text()
         if s == '':
             s = None
-        self.populate(parent=self.__current, search=s)
+        
+        if not background:
+            self.populate(parent=self.__current, search=s)
+            self.searchChanged.emit(self.__search)
+            return
+        
+        self.__cacheShown()
+        self.__generation += 1
+        level = self.__setLevel(self.__current, s, False)
+        if self.__refineSearch(level, s):
+            pass
+        elif (level, s) in self.__levels:
+            self.__show(level, s, self.__levels[(level, s)], [])
+        else:
+            task = SearchTask(self, self.__generation, level, s)
+            self.__tasks.add(task)
+            self.searchPool.start(task)
         self.searchChanged.emit(self.__search)
+    
+    def onSearchDone(self, task, rows, sources):
+        self.__tasks.discard(task)
+        if task.generation != self.__generation:
+            # Another search or navigation happened since
+            return
+        
+        if rows is None:
+            # Try again, and let it fail here
+            self.populate(parent=self.__current, search=task.search)
+        else:
+            self.__show(task.level, task.search, rows, sources)
 
-    def onListItemActivated(self):
-        item = self.list.currentItem()
-        data, t = item.data(ITEM), item.data(TYPE)
+    def onListItemActivated(self, index=None):
+        if index is None:
+            index = self.list.currentIndex()
+        if not index.isValid():
+            return
+        row = self.model.row(index.row())
+        data, t = row.data, row.type
         if t == PARENT:
             self.__tree.append(self.__current)
             self.populate(parent=data, search=self.__search)
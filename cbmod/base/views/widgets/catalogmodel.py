@@ -0,0 +1,311 @@
+import difflib
+import itertools
+
+from PySide import QtGui, QtCore
+
+import cbpos
+logger = cbpos.get_logger(__name__)
+
+from cbmod.base.views import icons
+from cbmod.base.views.imageloader import ImageLoader
+
+PARENT, CHILD, UP, ALL = 0, 1, 2, 3
+ITEM, TYPE = QtCore.Qt.UserRole+1, QtCore.Qt.UserRole+2
+
+class CatalogRow(object):
+    __slots__ = ('label', 'image', 'data', 'type', 'icon')
+
+    def __init__(self, label, image, data, t):
+        self.label = label
+        self.image = image
+        self.data = data
+        self.type = t
+        self.icon = None
+
+    def key(self):
+        """
+        Identifies the row when comparing the contents before and after
+        an update, see CatalogModel.update.
+        """
+        data_key = getattr(self.data, 'id', None)
+        if data_key is None and self.data is not None:
+            data_key = id(self.data)
+        return (self.type, data_key, self.label)
+
+    def image_key(self):
+        if not self.image:
+            return None
+        return icons.IconCache.key(self.image) or id(self.image)
+
+    @classmethod
+    def from_data(cls, data, t):
+        """
+        Creates a row for an item returned by Catalog.getAll or
+        Catalog.getChildren, which is either an item or (item, image).
+        """
+        try:
+            item, image = data
+        except (TypeError, ValueError):
+            item = data
+            image = None
+        return cls(item.display, image, item, t)
+
+class PagedSource(object):
+    """
+    Fetches the items of a query, or of any iterable, a page at a time.
+    Queries are fetched with LIMIT/OFFSET so that no cursor is left open
+    between two pages.
+    """
+
+    def __init__(self, source, t):
+        self.type = t
+        self.exhausted = False
+
+        if hasattr(source, 'slice'):
+            self.__query = source
+            self.__offset = 0
+            self.__iter = None
+        else:
+            self.__query = None
+            self.__iter = iter(source)
+
+    def fetch(self, count):
+        if self.exhausted:
+            return []
+
+        if self.__query is not None:
+            items = self.__query.slice(self.__offset, self.__offset+count).all()
+            self.__offset += len(items)
+        else:
+            items = list(itertools.islice(self.__iter, count))
+
+        if len(items) < count:
+            self.exhausted = True
+
+        return [CatalogRow.from_data(data, self.type) for data in items]
+
+class CatalogModel(QtCore.QAbstractListModel):
+    """
+    List model of the catalog, which only fetches rows from its sources
+    as the view needs them, and decodes images as they get shown.
+    """
+
+    PAGE_SIZE = 100
+
+    def __init__(self, icons, icon_size, parent=None):
+        super(CatalogModel, self).__init__(parent)
+
+        # Placeholder icons by type
+        self.icons = icons
+        self.icon_size = icon_size
+
+        self.rows = []
+        self.__sources = []
+
+        self.loader = ImageLoader(self)
+        self.loader.loaded.connect(self.onImageLoaded)
+        # request -> (row waiting for its icon, persistent index of the row)
+        self.__loading = {}
+
+    def reset(self, rows, sources=()):
+        """
+        Replace the contents with `rows`, followed by the items of
+        `sources`, a list of PagedSource's or (iterable, type), which are
+        fetched lazily.
+        """
+        # The rows waiting for their images are about to be dropped,
+        # they may be shown again later so they will have to ask again
+        self.loader.cancel()
+        for row, index in self.__loading.itervalues():
+            row.icon = None
+        self.__loading.clear()
+
+        self.beginResetModel()
+        self.rows = list(rows)
+        self.__sources = self.__makeSources(sources)
+        self.endResetModel()
+
+    def __makeSources(self, sources):
+        sources = [s if isinstance(s, PagedSource) else PagedSource(*s)
+                        for s in sources]
+        return [s for s in sources if not s.exhausted]
+
+    def update(self, rows, sources=()):
+        """
+        Same as `reset`, but only removes and inserts the rows of the first
+        page that changed, so that the selection and the icons of the others
+        are kept. The rows after the first page are replaced, and fetched
+        lazily again.
+        """
+        rows = list(rows)
+        sources = self.__makeSources(sources)
+        
+        # Only the first page is compared
+        while sources and len(rows) < self.PAGE_SIZE:
+            source = sources[0]
+            rows.extend(source.fetch(self.PAGE_SIZE - len(rows)))
+            if source.exhausted:
+                sources.pop(0)
+        rows, rest = rows[:self.PAGE_SIZE], rows[self.PAGE_SIZE:]
+        
+        # Do not let the view fetch more while the rows are being changed
+        self.__sources = []
+        
+        if len(self.rows) > self.PAGE_SIZE:
+            self.__removeRows(self.PAGE_SIZE, len(self.rows))
+        
+        matcher = difflib.SequenceMatcher(None,
+                                          [r.key() for r in self.rows],
+                                          [r.key() for r in rows],
+                                          autojunk=False)
+        # From the end, so that the indexes of the earlier changes stay valid
+        for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+            if tag == 'equal':
+                for i, new in enumerate(rows[j1:j2], i1):
+                    self.__refreshRow(i, new)
+                continue
+            
+            if i2 > i1:
+                self.__removeRows(i1, i2)
+            if j2 > j1:
+                self.beginInsertRows(QtCore.QModelIndex(), i1, i1+j2-j1-1)
+                self.rows[i1:i1] = rows[j1:j2]
+                self.endInsertRows()
+        
+        if rest:
+            count = len(self.rows)
+            self.beginInsertRows(QtCore.QModelIndex(), count, count+len(rest)-1)
+            self.rows.extend(rest)
+            self.endInsertRows()
+        
+        self.__sources = sources
+
+    def __removeRows(self, i1, i2):
+        """
+        Removes the rows from `i1` to `i2`, cancelling the requests
+        for the images they were waiting for.
+        """
+        removed = set(id(row) for row in self.rows[i1:i2])
+        for request, (row, index) in self.__loading.items():
+            if id(row) in removed:
+                del self.__loading[request]
+                self.loader.forget(request)
+                # It has to ask again if it is shown later
+                row.icon = None
+        
+        self.beginRemoveRows(QtCore.QModelIndex(), i1, i2-1)
+        del self.rows[i1:i2]
+        self.endRemoveRows()
+
+    def __refreshRow(self, i, new):
+        """
+        Keeps the existing row at `i` but with the data of the `new` one.
+        """
+        row = self.rows[i]
+        row.data = new.data
+        if row.image_key() != new.image_key():
+            row.image = new.image
+            row.icon = None
+            index = self.index(i)
+            self.dataChanged.emit(index, index)
+
+    def appendRow(self, row):
+        count = len(self.rows)
+        self.beginInsertRows(QtCore.QModelIndex(), count, count)
+        self.rows.append(row)
+        self.endInsertRows()
+
+    def row(self, index):
+        return self.rows[index]
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return False
+        return len(self.__sources) > 0
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return
+
+        rows = []
+        while self.__sources and len(rows) < self.PAGE_SIZE:
+            source = self.__sources[0]
+            rows.extend(source.fetch(self.PAGE_SIZE - len(rows)))
+            if source.exhausted:
+                self.__sources.pop(0)
+
+        if rows:
+            count = len(self.rows)
+            self.beginInsertRows(QtCore.QModelIndex(), count, count+len(rows)-1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+
+    def fetchAtLeast(self, count):
+        """
+        Fetch rows until there are `count` of them or no more to fetch.
+        """
+        while len(self.rows) < count and self.canFetchMore():
+            self.fetchMore()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row = self.rows[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return row.label
+        elif role == QtCore.Qt.DecorationRole:
+            return self.rowIcon(row, index)
+        elif role == ITEM:
+            return row.data
+        elif role == TYPE:
+            return row.type
+        return None
+
+    def rowIcon(self, row, index=None):
+        """
+        Returns the icon of the row, requesting its image
+        the first time the row is shown. `index` is the index of the row,
+        if known, which is updated once the image is decoded.
+        """
+        if row.icon is not None:
+            return row.icon
+
+        if not row.image:
+            row.icon = self.icons[row.type]
+            return row.icon
+
+        request, icon = self.loader.load(row.image, self.icon_size)
+        if icon is None:
+            # Show a placeholder until the image is decoded
+            if index is not None:
+                # Follows the row as others are inserted or removed
+                index = QtCore.QPersistentModelIndex(index)
+            self.__loading[request] = (row, index)
+            icon = self.icons[row.type]
+        row.icon = icon
+        return icon
+
+    def onImageLoaded(self, request, icon):
+        row, index = self.__loading.pop(request, (None, None))
+        if row is None or icon.isNull():
+            return
+
+        row.icon = icon
+        if index is not None:
+            if not index.isValid():
+                # The row was removed
+                return
+            i = index.row()
+        else:
+            try:
+                i = self.rows.index(row)
+            except ValueError:
+                return
+        index = self.index(i)
+        self.dataChanged.emit(index, index)
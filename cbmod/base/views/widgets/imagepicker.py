@@ -3,16 +3,23 @@ from PySide import QtCore, QtGui
 import cbpos
 logger = cbpos.get_logger(__name__)
 
+from cbmod.base.views.imageloader import ImageLoader
+
 class ImagePicker(QtGui.QPushButton):
     
     __image = None
     __path = None
+    __request = None
     
     def __init__(self):
         super(ImagePicker, self).__init__()
         
+        self.setIconSize(QtCore.QSize(48, 48))
         self.pressed.connect(self.onPress)
         
+        self.loader = ImageLoader(self)
+        self.loader.loaded.connect(self.onImageLoaded)
+        
         self.updateText()
     
     def onPress(self):
@@ -24,6 +31,26 @@ class ImagePicker(QtGui.QPushButton):
             self.setText("Change")
         else:
             self.setText("Set Image")
+        self.updateIcon()
+    
+    def updateIcon(self):
+        self.loader.cancel()
+        self.__request = None
+        
+        source = self.__path or self.__image
+        if source:
+            request, icon = self.loader.load(source, self.iconSize())
+            if icon is None:
+                # Decoding a big photo would freeze the interface
+                self.__request = request
+                icon = QtGui.QIcon()
+        else:
+            icon = QtGui.QIcon()
+        self.setIcon(icon)
+    
+    def onImageLoaded(self, request, icon):
+        if request == self.__request:
+            self.setIcon(icon)
     
     def setImage(self, image):
         self.__image = image
@@ -0,0 +1,54 @@
+from collections import defaultdict
+
+class SearchIndex(object):
+    """
+    In-memory trigram index over the labels of a set of catalog rows,
+    all of which matched `query` for the catalog `level`.
+    Any query which contains `query` can be answered from the index alone,
+    as long as searches match the labels by case-insensitive substring.
+    """
+
+    N = 3
+
+    def __init__(self, level, query, rows):
+        self.level = level
+        self.query = query
+        self.rows = rows
+
+        self.__labels = [self.normalize(row.label) for row in rows]
+        self.__grams = defaultdict(set)
+        for i, label in enumerate(self.__labels):
+            for gram in self.grams(label):
+                self.__grams[gram].add(i)
+
+    @staticmethod
+    def normalize(text):
+        return unicode(text).lower()
+
+    @classmethod
+    def grams(cls, text):
+        return set(text[i:i+cls.N] for i in xrange(len(text)-cls.N+1))
+
+    def covers(self, level, query):
+        """
+        Whether the results for `query` on `level` are all in the index.
+        """
+        if level != self.level or query is None:
+            return False
+        return self.normalize(self.query) in self.normalize(query)
+
+    def search(self, query):
+        """
+        Returns the rows matching `query`, in their original order.
+        """
+        query = self.normalize(query)
+
+        grams = self.grams(query)
+        if grams:
+            sets = sorted((self.__grams.get(g, set()) for g in grams), key=len)
+            candidates = set(sets[0]).intersection(*sets[1:])
+        else:
+            # Too short to use the index
+            candidates = xrange(len(self.rows))
+
+        return [self.rows[i] for i in sorted(candidates) if query in self.__labels[i]]
@@ -4,7 +4,49 @@ from PySide import QtCore, QtGui
 import cbpos
 logger = cbpos.get_logger(__name__)
 
+from cbmod.base import profiling
+
 from .page import BasePage
+from . import icons
+
+class LazyPage(QtGui.QWidget):
+    """
+    Placeholder for the page of a menu item, which is only constructed
+    the first time it is shown.
+    """
+    shown = QtCore.Signal()
+    
+    def __init__(self, item):
+        super(LazyPage, self).__init__()
+        
+        self.item = item
+        self.page = None
+        
+        layout = QtGui.QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+        
+        self.shown.connect(self.onShown)
+    
+    def load(self):
+        """
+        Constructs the page if it was not yet, and returns it.
+        """
+        if self.page is None:
+            logger.debug('Loading menu page for %s', self.item.name)
+            with profiling.phase(self.item.name, 'page'):
+                self.page = self.item.page()
+                self.layout().addWidget(self.page)
+        return self.page
+    
+    def onShown(self):
+        page = self.load()
+        try:
+            signal = page.shown
+        except AttributeError:
+            pass
+        else:
+            signal.emit()
 
 class MainWindow(QtGui.QMainWindow):
     __inits = []
@@ -42,10 +84,13 @@ class MainWindow(QtGui.QMainWindow):
         
         self.setWindowTitle('Coinbox')
         
-        self.callInit()
+        with profiling.phase('MainWindow.callInit'):
+            self.callInit()
         
-        self.loadToolbar()
-        self.loadMenu()
+        with profiling.phase('MainWindow.loadToolbar'):
+            self.loadToolbar()
+        with profiling.phase('MainWindow.loadMenu'):
+            self.loadMenu()
     
     def loadToolbar(self):
         """
@@ -56,8 +101,8 @@ class MainWindow(QtGui.QMainWindow):
         mwGeom  = cbpos.config['mainwindow', 'geometry']
 
         for act in cbpos.menu.actions:
-            # TODO: Remember to load an icon with a proper size (eg 48x48 px for touchscreens)
-            action = QtGui.QAction(QtGui.QIcon(act.icon), act.label, self)
+            icon = icons.manager.icon(act.icon, self.toolbar.iconSize())
+            action = QtGui.QAction(icon, act.label, self)
             action.setShortcut(act.shortcut)
             action.triggered.connect(act.trigger)
             self.toolbar.addAction(action)
@@ -102,14 +147,14 @@ class MainWindow(QtGui.QMainWindow):
             
             # Add the tab
             widget = self.getTabWidget(children)
-            icon = QtGui.QIcon(root.icon)
+            icon = icons.manager.icon(root.icon, self.tabs.iconSize())
             index = self.tabs.addTab(widget, icon, root.label)
             widget.setEnabled(root.enabled)
             
             # Add the toolbar action if enabled
             if hide_tab_bar:
-                # TODO: Remember to load an icon with a proper size (eg 48x48 px for touchscreens)
-                action = QtGui.QAction(QtGui.QIcon(icon), root.label, self)
+                toolbar_icon = icons.manager.icon(root.icon, self.toolbar.iconSize())
+                action = QtGui.QAction(toolbar_icon, root.label, self)
                 action.onTrigger = lambda n=index: self.tabs.setCurrentIndex(n)
                 action.triggered.connect(action.onTrigger)
                 self.toolbar.addAction(action)
@@ -117,7 +162,19 @@ class MainWindow(QtGui.QMainWindow):
     def onCurrentTabChanged(self, index, tabs=None):
         if tabs is None:
             tabs = self.tabs
-        widget = tabs.widget(index)
+        elif not tabs.isVisible():
+            # Nested tabs which are being filled, or are hidden:
+            # their current page is shown along with their parent tab
+            return
+        self.emitShown(tabs.widget(index))
+    
+    def emitShown(self, widget):
+        """
+        Emits the `shown` signal of the page, constructing it if it is a LazyPage.
+        """
+        if isinstance(widget, QtGui.QTabWidget):
+            return self.emitShown(widget.currentWidget())
+        
         try:
             signal = widget.shown
         except AttributeError:
@@ -129,6 +186,7 @@ class MainWindow(QtGui.QMainWindow):
         """
         Returns the appropriate window to be placed in the main QTabWidget,
         depending on the number of children of a root menu item.
+        Pages are only constructed when they are first shown, see LazyPage.
         """
         count = len(items)
         if count == 0:
@@ -138,8 +196,7 @@ class MainWindow(QtGui.QMainWindow):
             return widget
         elif count == 1:
             # If there is only one item, show it as is.
-            logger.debug('Loading menu page for %s', items[0].name)
-            widget = items[0].page()
+            widget = LazyPage(items[0])
             widget.setEnabled(items[0].enabled)
             return widget
         else:
@@ -148,10 +205,8 @@ class MainWindow(QtGui.QMainWindow):
             tabs.currentChanged.connect(lambda i, t=tabs: self.onCurrentTabChanged(i, t))
 
             for item in items:
-                logger.debug('Loading menu page for %s', item.name)
-                
-                widget = item.page()
-                icon = QtGui.QIcon(item.icon)
+                widget = LazyPage(item)
+                icon = icons.manager.icon(item.icon, tabs.iconSize())
                 tabs.addTab(widget, icon, item.label)
                 widget.setEnabled(item.enabled)
             return tabs
@@ -172,6 +227,7 @@ class MainWindow(QtGui.QMainWindow):
         Perform necessary operations before closing the window.
         """
         self.saveWindowState()
+        logger.debug('Icon cache statistics: %s', icons.manager.stats())
         #do any other thing before closing...
         event.accept()
     
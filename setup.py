@@ -10,6 +10,13 @@ setup(
       namespace_packages=['cbmod'],
       include_package_data=True,
       
+      entry_points={
+            'console_scripts': [
+                  'coinbox-import-images = cbmod.base.controllers.imageimport:main',
+                  'coinbox-profile = cbmod.base.profiling:main'
+            ]
+      },
+      
       install_requires=[
             'sqlalchemy>=0.7, <1.0',
             'PyDispatcher>=2.0.3, <3.0',
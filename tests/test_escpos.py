@@ -0,0 +1,84 @@
+"""
+Bytes sent to ESC/POS printers, through a file and a local socket.
+"""
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from cbmod.base.controllers import escpos, printing
+
+INIT = '\x1b@'
+END = '\x1bd\x03' + '\x1dVB\x00'
+
+class ReceiptJob(printing.PrintJob):
+    def __init__(self, lines):
+        self.lines = lines
+
+    def escpos(self, writer):
+        for line in self.lines:
+            writer.text(line)
+
+class EscPosTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix='coinbox-escpos-')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def printed(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_receipt(self):
+        printer = printing.EscPosPrinter('receipt', self.path, columns=16)
+        printer.execute(ReceiptJob([u'Caf\xe9 2,50\u20ac', 'Th\xc3\xa9 1,20']))
+        # Unicode and UTF-8 text in cp437, with what it lacks replaced
+        self.assertEqual(self.printed(), INIT + 'Caf\x82 2,50?\n' + 'Th\x82 1,20\n' + END)
+
+    def test_wrap(self):
+        printer = printing.EscPosPrinter('receipt', self.path, columns=10)
+        printer.execute(ReceiptJob([u'one two three four']))
+        self.assertEqual(self.printed(), INIT + 'one two\nthree four\n' + END)
+
+    def test_no_cut(self):
+        printer = printing.EscPosPrinter('receipt', self.path, columns=16, cut=False)
+        printer.execute(ReceiptJob([u'Total']))
+        self.assertEqual(self.printed(), INIT + 'Total\n' + '\x1bd\x03')
+
+    def test_socket(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+
+        def accept():
+            conn, _ = server.accept()
+            try:
+                for data in iter(lambda: conn.recv(4096), ''):
+                    received.append(data)
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=accept)
+        thread.start()
+        try:
+            printer = printing.EscPosPrinter('receipt', 'tcp://127.0.0.1:{}'.format(server.getsockname()[1]),
+                                             columns=16)
+            printer.execute(ReceiptJob([u'Caf\xe9']))
+            thread.join(10)
+        finally:
+            server.close()
+
+        self.assertEqual(''.join(received), INIT + 'Caf\x82\n' + END)
+
+    def test_column_widths(self):
+        self.assertEqual(escpos.EscPosWriter.column_widths(3, 48), [16, 16, 16])
+        self.assertEqual(escpos.EscPosWriter.column_widths(3, 32), [12, 10, 10])
+        self.assertEqual(escpos.EscPosWriter.column_widths(0, 32), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+Reference counting of the blobs shared by stored files, and the upgrade of
+the storedfiles table from the schema where it held the contents.
+Runs on an in-memory SQLite database.
+"""
+import hashlib
+import unittest
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine.reflection import Inspector
+
+from cbmod.base.models import StoredBlob, StoredBlobChunk, StoredFile
+from cbmod.base.models import migrations
+
+BLOB_TABLES = [StoredBlob.__table__, StoredBlobChunk.__table__]
+
+def sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+class StoredBlobTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        StoredFile.metadata.create_all(self.engine, tables=BLOB_TABLES + [StoredFile.__table__])
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+    def blobs(self):
+        table = StoredBlob.__table__
+        return dict((row.hash, row.refcount) for row in
+                    self.engine.execute(select([table.c.hash, table.c.refcount])))
+
+    def chunk_count(self):
+        return self.engine.execute(StoredBlobChunk.__table__.count()).scalar()
+
+    def test_shared_content(self):
+        first = StoredFile('first.txt', 'content')
+        second = StoredFile('second.txt', 'content')
+        self.session.add_all([first, second])
+        self.session.commit()
+        self.assertEqual(self.blobs(), {sha256('content'): 2})
+
+        self.session.delete(first)
+        self.session.commit()
+        self.assertEqual(self.blobs(), {sha256('content'): 1})
+        self.assertEqual(second.content, 'content')
+
+    def test_deleted_at_zero(self):
+        f = StoredFile('big.bin', 'x' * 10, chunked=True)
+        self.session.add(f)
+        self.session.commit()
+        self.assertEqual(self.blobs(), {sha256('x' * 10): 1})
+        self.assertEqual(self.chunk_count(), 1)
+
+        self.session.delete(f)
+        self.session.commit()
+        self.assertEqual(self.blobs(), {})
+        self.assertEqual(self.chunk_count(), 0)
+
+    def test_replaced_content(self):
+        first = StoredFile('first.txt', 'old')
+        second = StoredFile('second.txt', 'old')
+        self.session.add_all([first, second])
+        self.session.commit()
+
+        first.content = 'new'
+        self.session.commit()
+        self.assertEqual(self.blobs(), {sha256('old'): 1, sha256('new'): 1})
+
+        second.content = 'new'
+        self.session.commit()
+        self.assertEqual(self.blobs(), {sha256('new'): 2})
+
+    def test_rolled_back(self):
+        f = StoredFile('file.txt', 'content')
+        self.session.add(f)
+        self.session.flush()
+        self.session.rollback()
+        self.assertEqual(self.blobs(), {})
+
+        # The content is stored again on the next flush
+        self.session.add(f)
+        self.session.commit()
+        self.assertEqual(self.blobs(), {sha256('content'): 1})
+        self.assertEqual(f.content, 'content')
+
+class UpgradeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        StoredFile.metadata.create_all(self.engine, tables=BLOB_TABLES)
+        # The storedfiles table as it was when it held the contents
+        self.engine.execute('CREATE TABLE storedfiles ('
+                                'id INTEGER PRIMARY KEY, '
+                                'filename VARCHAR(255), '
+                                'filetype VARCHAR(5), '
+                                'content BLOB)')
+        for id, content in ((1, 'shared'), (2, 'shared'), (3, 'alone'), (4, '')):
+            self.engine.execute('INSERT INTO storedfiles (id, filename, filetype, content) '
+                                'VALUES (?, ?, ?, ?)', id, 'file{}'.format(id), '.txt', content)
+
+    def upgrade(self):
+        connection = self.engine.connect()
+        with connection.begin():
+            migrations.upgrade_storedfiles(connection)
+        connection.close()
+
+    def test_upgrade(self):
+        self.upgrade()
+
+        columns = set(c['name'] for c in Inspector.from_engine(self.engine).get_columns('storedfiles'))
+        self.assertTrue(set(migrations.STOREDFILE_COLUMNS) <= columns)
+
+        files = dict((row.id, (row.hash, row.size)) for row in
+                     self.engine.execute('SELECT id, hash, size FROM storedfiles'))
+        self.assertEqual(files, {1: (sha256('shared'), 6),
+                                 2: (sha256('shared'), 6),
+                                 3: (sha256('alone'), 5),
+                                 4: (sha256(''), 0)})
+
+        table = StoredBlob.__table__
+        blobs = dict((row.hash, (row.refcount, row.content)) for row in
+                     self.engine.execute(select([table.c.hash, table.c.refcount, table.c.content])))
+        self.assertEqual(blobs, {sha256('shared'): (2, 'shared'),
+                                 sha256('alone'): (1, 'alone'),
+                                 sha256(''): (1, '')})
+
+        if 'content' in columns:
+            # SQLite could not drop it
+            contents = [row.content for row in self.engine.execute('SELECT content FROM storedfiles')]
+            self.assertEqual(contents, [None] * 4)
+
+    def test_upgrade_twice(self):
+        self.upgrade()
+        self.upgrade()
+
+        table = StoredBlob.__table__
+        refcounts = [row.refcount for row in self.engine.execute(select([table.c.refcount]))]
+        self.assertEqual(sorted(refcounts), [1, 1, 2])
+
+if __name__ == '__main__':
+    unittest.main()